@@ -30,6 +30,7 @@ import paramiko
 LOGO="Accounting"
 WORK_DIR = os.environ.get("ACC_WORKDIR", "/opt/sysadmws/accounting")
 LOG_DIR = os.environ.get("ACC_LOGDIR", "/opt/sysadmws/accounting/log")
+CACHE_DIR = os.environ.get("ACC_CACHEDIR", "/opt/sysadmws/accounting/cache")
 LOG_FILE = "accounting.log"
 TARIFFS_SUBDIR = "tariffs"
 CLIENTS_SUBDIR = "clients"
@@ -215,12 +216,14 @@ if __name__ == "__main__":
     parser.add_argument("--dry-run-woocommerce", dest="dry_run_woocommerce", help="no woocommerce api commands executed", action="store_true")
     parser.add_argument("--timelogs-spent-before-date", dest="timelogs_spent_before_date", help="select unchecked timelogs for hourly invoices spent before date DATE", nargs=1, metavar=("DATE"))
     parser.add_argument("--at-date", dest="at_date", help="use DATETIME instead of now for tariff", nargs=1, metavar=("DATETIME"))
+    parser.add_argument("--workers", dest="workers", help="load client yamls with includes in N parallel processes", nargs=1, metavar=("N"))
     group = parser.add_mutually_exclusive_group(required=False)
     group.add_argument("--exclude-clients", dest="exclude_clients", help="exclude clients defined by JSON_LIST from all-clients operations", nargs=1, metavar=("JSON_LIST"))
     group.add_argument("--include-clients", dest="include_clients", help="include only clients defined by JSON_LIST for all-clients operations", nargs=1, metavar=("JSON_LIST"))
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--db-structure", dest="db_structure", help="create database structure", action="store_true")
     group.add_argument("--yaml-check", dest="yaml_check", help="check yaml structure", action="store_true")
+    group.add_argument("--yaml-benchmark", dest="yaml_benchmark", help="print per file parse time of accounting, client, include and tariff yamls with pure python and libyaml C loaders, best of REPEAT", nargs=1, metavar=("REPEAT"))
     group.add_argument("--asset-labels", dest="asset_labels", help="sync asset labels", action="store_true")
     group.add_argument("--issues-check", dest="issues_check", help="report issue activities as new issue in accounting project", action="store_true")
     group.add_argument("--merge-requests-check", dest="merge_requests_check", help="report MR activities as new issue in accounting project", action="store_true")
@@ -258,7 +261,7 @@ if __name__ == "__main__":
         logger = set_logger(logging.ERROR, LOG_DIR, LOG_FILE)
 
     # Skip vars check where not needed
-    if not (args.yaml_check or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
+    if not (args.yaml_check or args.yaml_benchmark is not None or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
 
         PG_DB_HOST = os.environ.get("PG_DB_HOST")
         if PG_DB_HOST is None:
@@ -276,7 +279,7 @@ if __name__ == "__main__":
         if PG_DB_PASS is None:
             raise Exception("Env var PG_DB_PASS missing")
 
-    if not (args.yaml_check or args.list_assets_for_client is not None or args.list_assets_for_all_clients or args.db_structure):
+    if not (args.yaml_check or args.yaml_benchmark is not None or args.list_assets_for_client is not None or args.list_assets_for_all_clients or args.db_structure):
 
         GL_ADMIN_PRIVATE_TOKEN = os.environ.get("GL_ADMIN_PRIVATE_TOKEN")
         if GL_ADMIN_PRIVATE_TOKEN is None:
@@ -324,7 +327,7 @@ if __name__ == "__main__":
         os.chdir(WORK_DIR)
 
         # Skip pgconnect where not needed
-        if not (args.yaml_check or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
+        if not (args.yaml_check or args.yaml_benchmark is not None or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
 
             # Connect to PG
             dsn = "host={} dbname={} user={} password={}".format(PG_DB_HOST, PG_DB_NAME, PG_DB_USER, PG_DB_PASS)
@@ -349,13 +352,21 @@ if __name__ == "__main__":
             json_str, = args.exclude_clients
             exclude_clients_list = json.loads(json_str)
         else:
-            exclude_clients_list = []
+            exclude_clients_list = None
 
         if args.include_clients is not None:
             json_str, = args.include_clients
             include_clients_list = json.loads(json_str)
         else:
-            include_clients_list = []
+            include_clients_list = None
+
+        # Each client is loaded once per run and shared by all loops below
+        client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, YAML_EXT, logger, CACHE_DIR, exclude_clients_list, include_clients_list)
+
+        # Load clients in parallel if asked
+        if args.workers is not None:
+            workers, = args.workers
+            client_registry.preload(int(workers))
 
         if args.db_structure:
             
@@ -379,36 +390,11 @@ if __name__ == "__main__":
 
             errors = False
 
-            # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
-                
-                logger.info("Found client file: {0}".format(client_file))
-
-                # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            # For all clients
+            for client_file, client_dict in client_registry.items():
 
                 # Check if client is active
-                if client_dict["active"] and (
-                                                    (
-                                                        args.exclude_clients is not None
-                                                        and
-                                                        client_dict["name"].lower() not in exclude_clients_list
-                                                    )
-                                                    or
-                                                    (
-                                                        args.include_clients is not None
-                                                        and
-                                                        client_dict["name"].lower() in include_clients_list
-                                                    )
-                                                    or
-                                                    (
-                                                        args.exclude_clients is None
-                                                        and
-                                                        args.include_clients is None
-                                                    )
-                                                ):
+                if client_dict["active"] and client_registry.selected(client_dict):
 
                     asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, used_now)
 
@@ -515,15 +501,8 @@ if __name__ == "__main__":
             except Exception as e:
                 raise Exception("Caught exception on gsuite execution")
 
-            # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
-
-                logger.info("Found client file: {0}".format(client_file))
-
-                # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            # For all clients
+            for client_file, client_dict in client_registry.items():
                 
                 # Check specific client
                 if args.update_envelopes_for_client is not None:
@@ -535,25 +514,7 @@ if __name__ == "__main__":
                 if (
                         "papers" in client_dict
                         and
-                        (
-                            (
-                                args.exclude_clients is not None
-                                and
-                                client_dict["name"].lower() not in exclude_clients_list
-                            )
-                            or
-                            (
-                                args.include_clients is not None
-                                and
-                                client_dict["name"].lower() in include_clients_list
-                            )
-                            or
-                            (
-                                args.exclude_clients is None
-                                and
-                                args.include_clients is None
-                            )
-                        )
+                        client_registry.selected(client_dict)
                         and
                         (
                             (
@@ -646,15 +607,8 @@ if __name__ == "__main__":
             # Init empty list of new pdfs
             uploaded_pdfs = []
 
-            # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
-
-                logger.info("Found client file: {0}".format(client_file))
-
-                # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            # For all clients
+            for client_file, client_dict in client_registry.items():
                 
                 # Check specific client
                 if args.make_pdfs_for_client is not None:
@@ -800,36 +754,11 @@ if __name__ == "__main__":
             clients_dict = {}
             if args.make_gmail_drafts_for_all_clients or args.print_papers_for_all_clients:
 
-                # For *.yaml in client dir
-                for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
-
-                    logger.info("Found client file: {0}".format(client_file))
-
-                    # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                # For all clients
+                for client_file, client_dict in client_registry.items():
 
                     # Check client active and exclude/include
-                    if client_dict["active"] and (
-                                                        (
-                                                            args.exclude_clients is not None
-                                                            and
-                                                            client_dict["name"].lower() not in exclude_clients_list
-                                                        )
-                                                        or
-                                                        (
-                                                            args.include_clients is not None
-                                                            and
-                                                            client_dict["name"].lower() in include_clients_list
-                                                        )
-                                                        or
-                                                        (
-                                                            args.exclude_clients is None
-                                                            and
-                                                            args.include_clients is None
-                                                        )
-                                                    ):
+                    if client_dict["active"] and client_registry.selected(client_dict):
                         clients_dict[client_dict["name"]] = client_dict
             
             else:
@@ -843,9 +772,7 @@ if __name__ == "__main__":
                 else:
                     raise Exception("Impossible became possible")
 
-                client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_in_arg.lower(), YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                client_dict = client_registry.get(client_in_arg)
 
                 clients_dict[client_dict["name"]] = client_dict
 
@@ -1230,17 +1157,13 @@ if __name__ == "__main__":
 
         if args.yaml_check:
 
-            # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
-
-                logger.info("Found client file: {0}".format(client_file))
+            # For all clients
+            for client_file in client_registry.files():
 
                 try:
 
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                    client_dict = client_registry.load(client_file)
 
                     # Basic checks
 
@@ -1316,7 +1239,7 @@ if __name__ == "__main__":
                                             # If tariff has file key - load it
                                             if "file" in asset_tariff:
                                                 
-                                                tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
+                                                tariff_dict = load_tariff_yaml(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"], logger)
                                                 if tariff_dict is None:
                                                     
                                                     raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
@@ -1329,6 +1252,46 @@ if __name__ == "__main__":
                     logger.error("Client {client} yaml check exception".format(client=client_dict["name"]))
                     raise
 
+        if args.yaml_benchmark is not None:
+
+            repeat, = args.yaml_benchmark
+            try:
+                repeat = int(repeat)
+            except ValueError:
+                raise Exception("--yaml-benchmark REPEAT must be an integer, got {0}".format(repeat))
+            if repeat < 1:
+                raise Exception("--yaml-benchmark REPEAT must be 1 or more, got {0}".format(repeat))
+
+            # Accounting yaml, client yamls with include files and tariffs
+            benchmark_files = [ACC_YAML]
+            benchmark_files.extend(sorted(glob.glob("{0}/**/{1}".format(CLIENTS_SUBDIR, YAML_GLOB), recursive=True)))
+            benchmark_files.extend(sorted(glob.glob("{0}/**/{1}".format(TARIFFS_SUBDIR, YAML_GLOB), recursive=True)))
+
+            total_pure = 0
+            total_c = 0
+            print("file\tpure_ms\tc_ms\tspeedup")
+            for benchmark_file in benchmark_files:
+
+                time_pure, time_c = benchmark_yaml_file(benchmark_file, repeat)
+                total_pure += time_pure
+                if time_c is not None:
+                    total_c += time_c
+
+                print("{file}\t{pure:.3f}\t{c}\t{speedup}".format(
+                    file=benchmark_file,
+                    pure=time_pure*1000,
+                    c="{0:.3f}".format(time_c*1000) if time_c is not None else "n/a",
+                    speedup="{0:.1f}x".format(time_pure/time_c) if time_c else "n/a"
+                ))
+
+            print("TOTAL {files} files\t{pure:.3f}\t{c:.3f}\t{speedup}".format(
+                files=len(benchmark_files),
+                pure=total_pure*1000,
+                c=total_c*1000,
+                speedup="{0:.1f}x".format(total_pure/total_c) if total_c else "n/a"
+            ))
+            print("Loader in use: {0}".format(YamlLoader.__name__))
+
         if args.asset_labels:
             
             # Connect to GitLab
@@ -1337,15 +1300,8 @@ if __name__ == "__main__":
             if args.debug_gitlab:
                 gl.enable_debug()
         
-            # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
-                
-                logger.info("Found client file: {0}".format(client_file))
-
-                # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            # For all clients
+            for client_file, client_dict in client_registry.items():
 
                 # Check if client is active
                 if client_dict["active"]:
@@ -1388,7 +1344,7 @@ if __name__ == "__main__":
                                 # If tariff has file key - load it
                                 if "file" in asset_tariff:
                                     
-                                    tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
+                                    tariff_dict = load_tariff_yaml(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"], logger)
                                     if tariff_dict is None:
                                         
                                         raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
@@ -1426,16 +1382,9 @@ if __name__ == "__main__":
 
         if args.issues_check:
 
-            # For *.yaml in client dir
+            # For all clients
             clients_dict = {}
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
-
-                logger.info("Found client file: {0}".format(client_file))
-
-                # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            for client_file, client_dict in client_registry.items():
 
                 if "hourly_only" in client_dict["billing"]:
                     clients_dict[client_dict["name"].lower()] = {"hourly_only": client_dict["billing"]["hourly_only"]}
@@ -2113,16 +2062,9 @@ if __name__ == "__main__":
 
         if args.merge_requests_check:
 
-            # For *.yaml in client dir
+            # For all clients
             clients_dict = {}
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
-
-                logger.info("Found client file: {0}".format(client_file))
-
-                # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            for client_file, client_dict in client_registry.items():
 
                 if "hourly_only" in client_dict["billing"]:
                     clients_dict[client_dict["name"].lower()] = {"hourly_only": client_dict["billing"]["hourly_only"]}
@@ -3583,9 +3525,7 @@ if __name__ == "__main__":
                     client_name = timelogs_check_client.lower()
 
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_name, YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}/{2}.{3}".format(WORK_DIR, CLIENTS_SUBDIR, client_name, YAML_EXT))
+                    client_dict = client_registry.get(client_name)
 
                     # Find project ids for needed projects
 
@@ -4178,30 +4118,18 @@ if __name__ == "__main__":
                                 client_name = str(acc_yaml_dict["projects"][row_project_path_with_namespace]["client"]).lower()
 
                                 # Load client YAML
-                                client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_name, YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
-                                if client_dict is None:
-                                    raise Exception("Config file error or missing: {0}/{1}/{2}.{3}".format(WORK_DIR, CLIENTS_SUBDIR, client_name, YAML_EXT))
+                                client_dict = client_registry.get(client_name)
 
-                                # Check if other label name is asset
-                                else:
-
-                                    asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, used_now, False)
-
-                                    # If there are assets
-                                    if len(asset_list) > 0:
-
-                                        # Iterate over assets in client
-                                        for client_asset in asset_list:
+                                # Check if other label name is asset, assets are looked up by fqdn index
+                                client_asset = client_registry.asset_by_fqdn(client_dict, row_imr_labels_split_label)
+                                if client_asset is not None:
 
-                                            # Check if asset name matches label
-                                            if client_asset["fqdn"] == row_imr_labels_split_label:
-
-                                                # Find checked tariff
-                                                try:
-                                                    checked_tariffs = activated_tariff(client_asset["tariffs"], row_timelog_updated, logger)["tariffs"]
-                                                except:
-                                                    logger.error("Asset {asset} imr {gitlab}/{imr} find active tariff error".format(asset=client_asset["fqdn"], gitlab=acc_yaml_dict["gitlab"]["url"], imr=row_imr_link))
-                                                    raise
+                                    # Find checked tariff
+                                    try:
+                                        checked_tariffs = activated_tariff(client_asset["tariffs"], row_timelog_updated, logger)["tariffs"]
+                                    except:
+                                        logger.error("Asset {asset} imr {gitlab}/{imr} find active tariff error".format(asset=client_asset["fqdn"], gitlab=acc_yaml_dict["gitlab"]["url"], imr=row_imr_link))
+                                        raise
 
                                 # Check if we have some tariff to check
                                 # It is ok if None - it means the label is not asset label (not monetazible)
@@ -4217,7 +4145,7 @@ if __name__ == "__main__":
                                         # If tariff has file key - load it
                                         if "file" in checked_tariff:
                                             
-                                            tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, checked_tariff["file"]), logger)
+                                            tariff_dict = load_tariff_yaml(WORK_DIR, TARIFFS_SUBDIR, checked_tariff["file"], logger)
                                             if tariff_dict is None:
                                                 
                                                 raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, checked_tariff["file"]))
@@ -4459,37 +4387,12 @@ if __name__ == "__main__":
                     
                     month_in_arg, = args.make_monthly_invoice_for_all_clients
 
-                    # For *.yaml in client dir
+                    # For all clients
 
-                    for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
-
-                        logger.info("Found client file: {0}".format(client_file))
-
-                        # Load client YAML
-                        client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                        if client_dict is None:
-                            raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                    for client_file, client_dict in client_registry.items():
 
                         # Add only active clients and not excluded
-                        if client_dict["active"] and not ("monthly_invoice_disabled" in client_dict["billing"] and client_dict["billing"]["monthly_invoice_disabled"]) and (
-                                                            (
-                                                                args.exclude_clients is not None
-                                                                and
-                                                                client_dict["name"].lower() not in exclude_clients_list
-                                                            )
-                                                            or
-                                                            (
-                                                                args.include_clients is not None
-                                                                and
-                                                                client_dict["name"].lower() in include_clients_list
-                                                            )
-                                                            or
-                                                            (
-                                                                args.exclude_clients is None
-                                                                and
-                                                                args.include_clients is None
-                                                            )
-                                                        ):
+                        if client_dict["active"] and not ("monthly_invoice_disabled" in client_dict["billing"] and client_dict["billing"]["monthly_invoice_disabled"]) and client_registry.selected(client_dict):
                             clients_dict[client_dict["name"]] = client_dict
                 
                 else:
@@ -4498,9 +4401,7 @@ if __name__ == "__main__":
 
                     client_in_arg, month_in_arg = args.make_monthly_invoice_for_client
 
-                    client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_in_arg.lower(), YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                    client_dict = client_registry.get(client_in_arg)
 
                     clients_dict[client_dict["name"].lower()] = client_dict
 
@@ -4553,11 +4454,14 @@ if __name__ == "__main__":
                                         # If tariff has file key - load it
                                         if "file" in asset_tariff:
                                             
-                                            tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
+                                            tariff_dict = load_tariff_yaml(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"], logger)
                                             if tariff_dict is None:
                                                 
                                                 raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
 
+                                            # Tariff dict is shared via tariff cache, copy it before adding per asset keys
+                                            tariff_dict = dict(tariff_dict)
+
                                             # Add tariff activation date per asset
                                             tariff_dict["activated_date"] = str(activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)["activated"].strftime("%Y-%m-%d"))
                                             tariff_dict["added_date"] = str(activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)["added"].strftime("%Y-%m-%d"))
@@ -4649,9 +4553,7 @@ if __name__ == "__main__":
                     # Check invoice shift from client yaml if exist, if not = 0
                     
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client.lower(), YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}/{2}.{3}".format(WORK_DIR, CLIENTS_SUBDIR, client, YAML_EXT))
+                    client_dict = client_registry.get(client)
 
                     if "month_shift" in client_dict["billing"]["papers"]:
                         month_delta = int(month_in_arg) + int(client_dict["billing"]["papers"]["month_shift"])
@@ -4853,36 +4755,11 @@ if __name__ == "__main__":
                 # Dict of lists to store storage details for clients (no sense to mix different clients in one list)
                 storage_details = {}
 
-                # For *.yaml in client dir
-                for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
-                    
-                    logger.info("Found client file: {0}".format(client_file))
-
-                    # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                # For all clients
+                for client_file, client_dict in client_registry.items():
 
                     # Check if specific client and client is active
-                    if ((needed_client is not None and client_dict["name"].lower() == needed_client) or needed_client is None) and client_dict["active"] and (
-                                                                                                                                                                (
-                                                                                                                                                                    args.exclude_clients is not None
-                                                                                                                                                                    and
-                                                                                                                                                                    client_dict["name"].lower() not in exclude_clients_list
-                                                                                                                                                                )
-                                                                                                                                                                or
-                                                                                                                                                                (
-                                                                                                                                                                    args.include_clients is not None
-                                                                                                                                                                    and
-                                                                                                                                                                    client_dict["name"].lower() in include_clients_list
-                                                                                                                                                                )
-                                                                                                                                                                or
-                                                                                                                                                                (
-                                                                                                                                                                    args.exclude_clients is None
-                                                                                                                                                                    and
-                                                                                                                                                                    args.include_clients is None
-                                                                                                                                                                )
-                                                                                                                                                            ):
+                    if ((needed_client is not None and client_dict["name"].lower() == needed_client) or needed_client is None) and client_dict["active"] and client_registry.selected(client_dict):
 
                         asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, used_now)
 
@@ -4905,7 +4782,7 @@ if __name__ == "__main__":
                                         # If tariff has file key - load it
                                         if "file" in tariff:
                                             
-                                            tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, tariff["file"]), logger)
+                                            tariff_dict = load_tariff_yaml(WORK_DIR, TARIFFS_SUBDIR, tariff["file"], logger)
                                             if tariff_dict is None:
                                                 
                                                 raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, tariff["file"]))
@@ -5046,9 +4923,7 @@ if __name__ == "__main__":
                     logger.info(json.dumps(specific_invoice_details, indent=2))
                             
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client.lower(), YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}/{2}.{3}".format(WORK_DIR, CLIENTS_SUBDIR, client, YAML_EXT))
+                    client_dict = client_registry.get(client)
 
                     # Check if papers needed or not
                     if client_dict["billing"]["papers"]["invoice"]["print"] or client_dict["billing"]["papers"]["act"]["print"]:
@@ -5812,15 +5687,8 @@ if __name__ == "__main__":
 
         if args.list_assets_for_client is not None or args.list_assets_for_all_clients:
             
-            # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
-                
-                logger.info("Found client file: {0}".format(client_file))
-
-                # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            # For all clients
+            for client_file, client_dict in client_registry.items():
                 
                 # Check specific client
                 if args.list_assets_for_client is not None:
@@ -5881,15 +5749,8 @@ if __name__ == "__main__":
             # Save total count for ALL pseudo client per asset kind
             total_asset_count = {}
                 
-            # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
-                
-                logger.info("Found client file: {0}".format(client_file))
-
-                # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            # For all clients
+            for client_file, client_dict in client_registry.items():
 
                 # Check if client is active
                 if client_dict["active"]:
@@ -5959,14 +5820,16 @@ if __name__ == "__main__":
             gitlab_conn.close()
             
         # Skip connection close where not needed
-        if not (args.yaml_check or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
+        if not (args.yaml_check or args.yaml_benchmark is not None or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
             # Close connection
             conn.close()
 
     # Reroute catched exception to log
     except Exception as e:
         logger.exception(e)
+        log_tariff_cache_stats(logger)
         logger.info("Finished {LOGO} with errors".format(LOGO=LOGO))
         sys.exit(1)
 
+    log_tariff_cache_stats(logger)
     logger.info("Finished {LOGO}".format(LOGO=LOGO))
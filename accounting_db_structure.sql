@@ -124,6 +124,21 @@ CREATE INDEX IF NOT EXISTS jobs_log_asset_fqdn ON jobs_log (asset_fqdn);
 CREATE INDEX IF NOT EXISTS jobs_log_client ON jobs_log (client);
 CREATE INDEX IF NOT EXISTS jobs_log_job_id ON jobs_log (job_id);
 CREATE INDEX IF NOT EXISTS jobs_log_asset_fqdn_client_job_id_combo ON jobs_log (asset_fqdn, client, job_id);
+CREATE INDEX IF NOT EXISTS jobs_log_client_asset_fqdn_job_id_id_combo ON jobs_log (client, asset_fqdn, job_id, id DESC);
+CREATE INDEX IF NOT EXISTS jobs_log_lower_client_asset_fqdn_job_id_id_combo ON jobs_log (LOWER(client), asset_fqdn, job_id, id DESC);
+
+
+CREATE TABLE IF NOT EXISTS jobs_next_run (
+	client TEXT NOT NULL,
+	asset_fqdn TEXT NOT NULL,
+	job_id TEXT NOT NULL,
+	job_schedule TEXT NOT NULL,
+	next_run_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+	PRIMARY KEY (client, asset_fqdn, job_id)
+);
+
+CREATE INDEX IF NOT EXISTS jobs_next_run_next_run_at ON jobs_next_run (next_run_at);
 
 
 CREATE TABLE IF NOT EXISTS asset_count (
@@ -10,14 +10,17 @@ import subprocess
 import pytz
 from datetime import datetime
 from datetime import time
+from datetime import timedelta
+from time import sleep
 import psycopg2
-import base64
+import psycopg2.extras
 
 # Constants and envs
 
 LOGO="Jobs"
 WORK_DIR = os.environ.get("ACC_WORKDIR", "/opt/sysadmws/accounting")
 LOG_DIR = os.environ.get("ACC_LOGDIR", "/opt/sysadmws/accounting/log")
+CACHE_DIR = os.environ.get("ACC_CACHEDIR", "/opt/sysadmws/accounting/cache")
 LOG_FILE = "jobs.log"
 TARIFFS_SUBDIR = "tariffs"
 CLIENTS_SUBDIR = "clients"
@@ -26,6 +29,290 @@ YAML_EXT = "yaml"
 ACC_YAML = "accounting.yaml"
 LOCK_TIMEOUT = 600 # Supposed to be run each 10 minutes, so lock for 10 minutes
 MINUTES_JITTER = 10 # Jobs are run on some minute between 00 and 10 minutes each 10 minutes
+JOBS_LOG_BATCH = 100 # Job log rows are inserted in batches of this size at most
+SALT_PROJECT_CONCURRENCY = 1 # Pipelines of the same salt project are triggered one by one with --concurrency by default
+DAEMON_MAX_SLEEP = 60 # Daemon wakes up at least each minute to reload changed YAML
+DAEMON_FULL_RUN = 600 # Daemon checks all jobs and loads job runs from DB each 10 minutes, other runs check only jobs due by jobs_next_run
+GITLAB_PROJECT_CACHE_FILE = "gitlab_projects.json"
+GITLAB_PROJECT_CACHE_TTL = 86400 # Salt project metadata is asked from GitLab once a day
+
+# Funcs
+
+# Save buffered job log rows with one multi row insert and commit, buffer is emptied only if saved
+def save_jobs_log(conn, cur, job_log_rows, logger):
+    if len(job_log_rows) == 0:
+        return
+    sql = """
+    INSERT INTO
+            jobs_log
+            (
+                    jobs_script_run_at
+            ,       client
+            ,       asset_fqdn
+            ,       job_id
+            ,       job_level
+            ,       job_type
+            ,       job_cmd
+            ,       job_timeout
+            ,       job_tz
+            )
+    VALUES
+            %s
+    ;
+    """
+    logger.info("Query:")
+    logger.info(sql)
+    try:
+        psycopg2.extras.execute_values(cur, sql, job_log_rows)
+        logger.info("Query execution status:")
+        logger.info(cur.statusmessage)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise Exception("Caught exception on query execution")
+    logger.info("Saved {count} job log rows".format(count=len(job_log_rows)))
+    del job_log_rows[:]
+
+# Save buffered next runs of jobs with one multi row upsert and commit, buffer is emptied only if saved
+def save_jobs_next_run(conn, cur, job_next_run_rows, logger):
+    if len(job_next_run_rows) == 0:
+        return
+    sql = """
+    INSERT INTO
+            jobs_next_run
+            (
+                    client
+            ,       asset_fqdn
+            ,       job_id
+            ,       job_schedule
+            ,       next_run_at
+            )
+    VALUES
+            %s
+    ON CONFLICT (client, asset_fqdn, job_id) DO UPDATE SET
+            job_schedule = EXCLUDED.job_schedule
+    ,       next_run_at = EXCLUDED.next_run_at
+    ,       updated_at = now()
+    ;
+    """
+    logger.info("Query:")
+    logger.info(sql)
+    try:
+        psycopg2.extras.execute_values(cur, sql, list(job_next_run_rows.values()))
+        logger.info("Query execution status:")
+        logger.info(cur.statusmessage)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise Exception("Caught exception on query execution")
+    logger.info("Saved {count} job next run rows".format(count=len(job_next_run_rows)))
+    job_next_run_rows.clear()
+
+# Print job details and buffer job log row, last runs are kept in sync with jobs_log table
+def log_job_run(job_text, job_log_row, job_last_run_key, job_log_rows, job_last_runs):
+    print(job_text)
+    job_log_rows.append(job_log_row)
+    job_last_runs[job_last_run_key] = (job_log_row[0], job_log_row[8])
+
+# Log finished pool pipeline triggers, only successful ones are job runs, returns False if some trigger failed
+def collect_pipeline_triggers(pipeline_triggers, job_log_rows, job_last_runs, logger, wait=False):
+    success = True
+    not_finished = []
+    for pipeline_trigger in pipeline_triggers:
+        future, job_text, job_log_row, job_last_run_key = pipeline_trigger
+        if not wait and not future.done():
+            not_finished.append(pipeline_trigger)
+            continue
+        try:
+            returncode = future.result()
+        except Exception as e:
+            logger.exception(e)
+            returncode = None
+        if returncode == 0:
+            log_job_run(job_text, job_log_row, job_last_run_key, job_log_rows, job_last_runs)
+        else:
+            logger.error("Pipeline script failed with exit code {code}, job not logged: {job}".format(code=returncode, job=job_text))
+            success = False
+    pipeline_triggers[:] = not_finished
+    return success
+
+# Trigger salt_cmd job pipeline via GitLab API, bash script is run if API trigger fails, returns exit code
+def trigger_salt_cmd_pipeline(pipeline_trigger, salt_project, asset_fqdn, job, script, logger):
+    variables = {}
+    if job.severity_override is not None:
+        variables["SEVERITY_OVERRIDE"] = job.severity_override
+    if job.salt_ssh:
+        variables["SALT_SSH_IN_SALT"] = "true"
+    result, = pipeline_trigger.trigger_batch(salt_project, [(asset_fqdn, job.cmd, job.timeout, variables)])
+    if result["pipeline_id"] is not None:
+        return 0
+    # Tag or pipeline could be created already, job is failed without script to avoid double run
+    if not result["fallback"]:
+        logger.error("Triggering pipeline via GitLab API failed for {project} {asset}: {error}".format(project=salt_project, asset=asset_fqdn, error=result["error"]))
+        return 1
+    logger.warning("Triggering pipeline via GitLab API failed for {project} {asset}, running bash script:".format(project=salt_project, asset=asset_fqdn))
+    logger.warning(script)
+    return subprocess.run(script, shell=True, universal_newlines=True, executable="/bin/bash").returncode
+
+# Next due time of job in UTC for daemon, job is not tried again within MINUTES_JITTER minutes after last attempt
+def daemon_job_next_due(job_schedule, now, job_last_attempt, job_offset=0):
+    after = max(now, job_last_attempt + timedelta(minutes=MINUTES_JITTER-1)).astimezone(now.tzinfo)
+    job_next_run = job_schedule.next_run(after, job_last_attempt, job_offset)
+    if job_next_run is None:
+        return None
+    return job_next_run.astimezone(pytz.timezone("UTC"))
+
+# Reason why job is never run for asset (os include/exclude, disabled, licenses), None if job can run
+def job_asset_skip_reason(asset, job):
+    if job.os_include is not None and asset.os not in job.os_include:
+        return "os {os} is not in job os include list".format(os=asset.os)
+    if job.os_exclude is not None and asset.os in job.os_exclude:
+        return "os {os} is in job os exclude list".format(os=asset.os)
+    if job.disabled:
+        return "it is disabled"
+    # Search for all needed licenses in joined licenses of asset tariffs
+    if job.licenses is not None and not job.licenses <= asset.licenses:
+        return "required license list {lic_list_job} is not found in joined licenses {lic_list_tar} of all of asset tariffs".format(lic_list_job=sorted(job.licenses), lic_list_tar=sorted(asset.licenses))
+    return None
+
+# Load last runs of all jobs of client (ALL for all clients) from jobs_log in one query, job last run key -> (jobs_script_run_at, job_tz)
+def load_job_last_runs(cur, client, logger):
+    # Separate statements for all clients and one client, so one client lookup can use LOWER(client) index
+    if client == "ALL":
+        sql = """
+        SELECT DISTINCT ON (client, asset_fqdn, job_id)
+                client
+        ,       asset_fqdn
+        ,       job_id
+        ,       jobs_script_run_at
+        ,       job_tz
+        FROM
+                jobs_log
+        ORDER BY
+                client
+        ,       asset_fqdn
+        ,       job_id
+        ,       id DESC
+        ;
+        """
+    else:
+        sql = """
+        SELECT DISTINCT ON (client, asset_fqdn, job_id)
+                client
+        ,       asset_fqdn
+        ,       job_id
+        ,       jobs_script_run_at
+        ,       job_tz
+        FROM
+                jobs_log
+        WHERE
+                LOWER(client) = %(client)s
+        ORDER BY
+                client
+        ,       asset_fqdn
+        ,       job_id
+        ,       id DESC
+        ;
+        """
+    logger.info("Query:")
+    logger.info(sql)
+    cur.execute(sql, {"client": client})
+    job_last_runs = {}
+    for row in cur:
+        job_last_runs[(row[0], row[1], row[2])] = (row[3], row[4])
+    logger.info("Loaded {count} job last runs".format(count=len(job_last_runs)))
+    return job_last_runs
+
+# First scheduler run at or after time in UTC, runs are each step minutes from midnight
+def forecast_tick(at, step):
+    tick = at.replace(second=0, microsecond=0)
+    if tick < at:
+        tick += timedelta(minutes=1)
+    remainder = (tick.hour*60 + tick.minute) % step
+    if remainder > 0:
+        tick += timedelta(minutes=step-remainder)
+    return tick
+
+# Run times in UTC of job within [start, end) by model of scheduler running each step minutes, job last run before start is taken if known
+# Job schedule is shifted by offset minutes like with --spread, after run job is not run again within gap minutes
+def forecast_job_runs(job_schedule, job_tz, job_offset, start, end, step, gap, job_last_run=None):
+    job_runs = []
+    if job_last_run is None:
+        job_last_run = datetime.strptime("1970-01-01 00:00:00 +0000", "%Y-%m-%d %H:%M:%S %z")
+        tick = forecast_tick(start, step)
+    else:
+        tick = forecast_tick(max(start, job_last_run + timedelta(minutes=gap)), step)
+    while tick < end:
+        if job_schedule.is_due(tick.astimezone(job_tz) - timedelta(minutes=job_offset), job_last_run):
+            job_runs.append(tick)
+            job_last_run = tick
+            after = tick + timedelta(minutes=gap)
+        else:
+            after = tick + timedelta(minutes=1)
+        # Jump to first run when job can be due instead of checking each run
+        job_next_run = job_schedule.next_run(after.astimezone(job_tz) - timedelta(minutes=1), job_last_run, job_offset)
+        if job_next_run is None:
+            break
+        tick = forecast_tick(max(after, job_next_run.astimezone(pytz.timezone("UTC"))), step)
+    return job_runs
+
+# Shard of client or asset for --shard, 1..shards, stable between runs and hosts
+def shard_of(name, shards):
+    return int(hashlib.md5(name.lower().encode("utf-8")).hexdigest(), 16) % shards + 1
+
+# Take shard lock in PG so the same shard is not run twice on different runners, lock is released when connection closes
+def lock_shard(cur, shard, shards, logger):
+    lock_key = int(hashlib.md5("jobs.py shard {0}/{1}".format(shard, shards).encode("utf-8")).hexdigest(), 16) % 2**63
+    cur.execute("SELECT pg_try_advisory_lock(%(key)s);", {"key": lock_key})
+    if not cur.fetchone()[0]:
+        raise Exception("Shard {0}/{1} is locked by another jobs.py process".format(shard, shards))
+    logger.info("Shard {0}/{1} locked".format(shard, shards))
+
+# Print per client and total work of shard to rebalance shards
+def print_shard_summary(shard, shards, shard_stats):
+    total = collections.Counter()
+    for client, client_stats in sorted(shard_stats.items()):
+        print("Shard {shard}/{shards} client: {client} assets {assets} jobs {jobs} triggered {triggered} seconds {seconds:.1f}".format(
+            shard=shard, shards=shards, client=client, assets=client_stats["assets"], jobs=client_stats["jobs"], triggered=client_stats["triggered"], seconds=client_stats["seconds"]
+        ))
+        total.update(client_stats)
+    print("Shard {shard}/{shards}: clients {clients} assets {assets} jobs {jobs} triggered {triggered} seconds {seconds:.1f}".format(
+        shard=shard, shards=shards, clients=len(shard_stats), assets=total["assets"], jobs=total["jobs"], triggered=total["triggered"], seconds=total["seconds"]
+    ))
+
+# Minutes to shift job schedule by with --spread, stable for client/asset/job and less than MINUTES_JITTER
+def spread_offset(client, asset_fqdn, job_id):
+    return int(hashlib.md5("{0}/{1}/{2}".format(client, asset_fqdn, job_id).encode("utf-8")).hexdigest(), 16) % MINUTES_JITTER
+
+# Start quota keys with limits for job pipeline, salt jobs load client salt masters, salt-ssh jobs load prod runner
+# Quotas limit pipelines started in one daemon run, not pipelines running at once, pipeline scripts do not wait for pipelines to finish
+def job_quota_keys(client_dict, acc_yaml_dict, job, salt_master_quota, runner_quota):
+    quota_keys = []
+    if salt_master_quota is None and runner_quota is None:
+        return quota_keys
+    configuration_management = client_dict.get("configuration_management", {})
+    if configuration_management.get("type") == "salt" and not job.salt_ssh:
+        if salt_master_quota is not None and "salt" in configuration_management:
+            for salt_master in configuration_management["salt"].get("masters", []):
+                quota_keys.append((("salt master", salt_master["fqdn"]), salt_master_quota))
+    else:
+        if runner_quota is not None:
+            runner = client_dict["gitlab"]["salt_project"].get("runners", {}).get("prod")
+            if runner is None:
+                runner = acc_yaml_dict["gitlab"].get("salt_project", {}).get("runners", {}).get("prod")
+            # Jobs without prod runner are not limited
+            if runner is not None:
+                quota_keys.append((("runner", runner), runner_quota))
+    return quota_keys
+
+# Take one pipeline from quota of each key, returns reason if quota of some key is exhausted and nothing is taken
+def take_pipeline_quota(quota_used, quota_keys):
+    for key, limit in quota_keys:
+        if quota_used[key] >= limit:
+            return "{kind} {name} quota of {limit} pipeline starts per run is exhausted".format(kind=key[0], name=key[1], limit=limit)
+    for key, limit in quota_keys:
+        quota_used[key] += 1
+    return None
 
 # Main
 
@@ -41,12 +328,24 @@ if __name__ == "__main__":
                           action="store_true")
     parser.add_argument("--dry-run-pipeline", dest="dry_run_pipeline", help="do not execute pipeline script", action="store_true")
     parser.add_argument("--at-date", dest="at_date", help="use DATETIME instead of now for tariff", nargs=1, metavar=("DATETIME"))
+    parser.add_argument("--daemon", dest="daemon", help="keep running --run-jobs, wake up on job due times and reload only changed YAML, between full runs each {0} minutes check only jobs due by jobs_next_run table".format(DAEMON_FULL_RUN // 60), action="store_true")
+    parser.add_argument("--concurrency", dest="concurrency", help="trigger up to N job pipelines in parallel, pipelines of the same salt project are limited by --salt-project-concurrency", nargs=1, metavar=("N"))
+    parser.add_argument("--salt-project-concurrency", dest="salt_project_concurrency", help="trigger up to N pipelines of the same salt project in parallel with --concurrency, default {0}".format(SALT_PROJECT_CONCURRENCY), nargs=1, metavar=("N"))
+    parser.add_argument("--workers", dest="workers", help="load client yamls with includes in N parallel processes", nargs=1, metavar=("N"))
+    parser.add_argument("--spread", dest="spread", help="spread scheduled job starts over {0} minutes window by hash of client/asset/job, with --daemon only".format(MINUTES_JITTER), action="store_true")
+    parser.add_argument("--salt-master-quota", dest="salt_master_quota", help="start at most N scheduled job pipelines per salt master per daemon run (about each minute), other jobs wait for next runs, it is start rate quota, pipelines already running are not counted, with --daemon only", nargs=1, metavar=("N"))
+    parser.add_argument("--runner-quota", dest="runner_quota", help="start at most N scheduled salt-ssh job pipelines per prod runner per daemon run (about each minute), other jobs wait for next runs, it is start rate quota, pipelines already running are not counted, with --daemon only", nargs=1, metavar=("N"))
+    parser.add_argument("--forecast-step", dest="forecast_step", help="model jobs run each MINUTES minutes for --forecast, 1 for --daemon, default {0}".format(MINUTES_JITTER), nargs=1, metavar=("MINUTES"))
+    parser.add_argument("--shard", dest="shard", help="run jobs only for clients with stable hash in shard I of N (e.g. 1/4), the same shard cannot run twice at once", nargs=1, metavar=("I/N"))
+    parser.add_argument("--shard-by-asset", dest="shard_by_asset", help="hash assets instead of clients for --shard", action="store_true")
+    parser.add_argument("--native-pipelines", dest="native_pipelines", help="create salt_cmd job pipelines via GitLab API instead of pipeline_salt_cmd.sh with ref and variable names from gitlab:native_pipelines of accounting yaml, script is still used if salt project cannot be taken via API", action="store_true")
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--run-job", dest="run_job", help="run specific job id JOB for asset ASSET (use ALL for all assets) via GitLab pipelines for CLIENT (use ALL for all clients)", nargs=3, metavar=("CLIENT", "ASSET", "JOB"))
     group.add_argument("--run-jobs", dest="run_jobs", help="run jobs for asset ASSET (use ALL for all assets) via GitLab pipelines for CLIENT (use ALL for all clients)", nargs=2, metavar=("CLIENT", "ASSET"))
     group.add_argument("--force-run-job", dest="force_run_job", help="force run (omit time conditions) specific job id JOB for asset ASSET (use ALL for all assets) via GitLab pipelines for CLIENT (use ALL for all clients)", nargs=3, metavar=("CLIENT", "ASSET", "JOB"))
     group.add_argument("--force-run-jobs", dest="force_run_jobs", help="force run all jobs (omit time conditions) for asset ASSET (use ALL for all assets) via GitLab pipelines for CLIENT (use ALL for all clients)", nargs=2, metavar=("CLIENT", "ASSET"))
+    group.add_argument("--forecast", dest="forecast", help="print scheduled job pipeline counts per hour per salt project from START to END in UTC (YYYY-MM-DD or YYYY-MM-DD HH:MM), job last runs are taken from DB if PG_DB_* env vars are set, use with --forecast-step 1 and --spread to forecast daemon", nargs=2, metavar=("START", "END"))
     # This is deprecated but kept for history
     group.add_argument("--prune-run-tags", dest="prune_run_tags", help="prune all run_* tags older than AGE via GitLab API for CLIENT (use ALL for all clients)", nargs=2, metavar=("CLIENT", "AGE"))
 
@@ -63,7 +362,7 @@ if __name__ == "__main__":
         logger = set_logger(logging.ERROR, LOG_DIR, LOG_FILE)
 
     GL_ADMIN_PRIVATE_TOKEN = os.environ.get("GL_ADMIN_PRIVATE_TOKEN")
-    if GL_ADMIN_PRIVATE_TOKEN is None:
+    if GL_ADMIN_PRIVATE_TOKEN is None and not args.forecast:
         raise Exception("Env var GL_ADMIN_PRIVATE_TOKEN missing")
     
     errors = False
@@ -84,6 +383,36 @@ if __name__ == "__main__":
         
         # Do tasks
 
+        # Each client is loaded once per run and shared by all loops below
+        client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, YAML_EXT, logger, CACHE_DIR)
+
+        # Load clients in parallel if asked
+        if args.workers is not None:
+            workers, = args.workers
+            client_registry.preload(int(workers))
+
+        if args.daemon and not args.run_jobs:
+            raise Exception("--daemon can be used with --run-jobs only, use --forecast-step 1 to forecast daemon")
+        if args.forecast_step is not None and not args.forecast:
+            raise Exception("--forecast-step can be used with --forecast only")
+
+        # Runs each 10 minutes would start spread jobs in two spikes and jobs over quota would miss their 10 minutes window
+        if args.spread and not (args.daemon or args.forecast):
+            raise Exception("--spread can be used with --daemon or --forecast only")
+        if (args.salt_master_quota is not None or args.runner_quota is not None) and not args.daemon:
+            raise Exception("--salt-master-quota and --runner-quota can be used with --daemon only")
+
+        # Unpack shard
+        if args.shard is not None:
+            if not args.run_jobs:
+                raise Exception("--shard can be used with --run-jobs only")
+            shard_text, = args.shard
+            if not re.match(r"^[0-9]+/[0-9]+$", shard_text):
+                raise Exception("--shard should be I/N, e.g. 1/4")
+            shard, shards = [int(part) for part in shard_text.split("/")]
+            if not 1 <= shard <= shards:
+                raise Exception("--shard I should be from 1 to N")
+
         if args.run_jobs or args.run_job or args.force_run_job or args.force_run_jobs:
 
             # Check db vars
@@ -112,533 +441,657 @@ if __name__ == "__main__":
             conn = psycopg2.connect(dsn)
             cur = conn.cursor()
 
-            # Save now once in UTC
-            # We cannot take now() within run jobs loops - each job run takes ~5 secs and thats why now drifts many minutes forward
-            saved_now = datetime.now(pytz.timezone("UTC"))
+            # Lock shard
+            if args.shard is not None:
+                lock_shard(cur, shard, shards, logger)
+
+            # Client to load job last runs for
+            if args.run_jobs:
+                last_run_client = args.run_jobs[0]
+            if args.run_job:
+                last_run_client = args.run_job[0]
+            if args.force_run_job:
+                last_run_client = args.force_run_job[0]
+            if args.force_run_jobs:
+                last_run_client = args.force_run_jobs[0]
+
+            # Job log rows not saved yet
+            job_log_rows = []
+
+            # Job next run rows not saved yet, job last run key -> row
+            job_next_run_rows = {}
+
+            # Pipeline quotas per salt master and runner
+            if args.salt_master_quota is not None:
+                salt_master_quota, = args.salt_master_quota
+                salt_master_quota = int(salt_master_quota)
+            else:
+                salt_master_quota = None
+            if args.runner_quota is not None:
+                runner_quota, = args.runner_quota
+                runner_quota = int(runner_quota)
+            else:
+                runner_quota = None
+
+            # Pipelines are triggered in pool if asked, pool triggers not finished yet are kept in pipeline_triggers
+            if args.concurrency is not None:
+                concurrency, = args.concurrency
+                if args.salt_project_concurrency is not None:
+                    salt_project_concurrency, = args.salt_project_concurrency
+                else:
+                    salt_project_concurrency = SALT_PROJECT_CONCURRENCY
+                pipeline_pool = PipelinePool(int(concurrency), int(salt_project_concurrency))
+            else:
+                pipeline_pool = None
+            pipeline_triggers = []
+
+            # Jobs tried by daemon, job last run key -> time, accounting yaml is reloaded by daemon on change
+            job_attempts = {}
+
+            # Daemon checks all jobs and loads job last and next runs from DB on full runs only
+            # Between full runs only jobs due by jobs_next_run table are checked for clients with the same YAML, client file -> (client dict, accounting yaml dict)
+            full_run_at = None
+            client_checked_yaml = {}
+            acc_yaml_mtime_ns = os.stat("{0}/{1}".format(WORK_DIR, ACC_YAML)).st_mtime_ns
             
-            # Connect to GitLab
-            gl = gitlab.Gitlab(acc_yaml_dict["gitlab"]["url"], private_token=GL_ADMIN_PRIVATE_TOKEN)
-            gl.auth()
+            # Connect to GitLab only when some job is run, salt project metadata is cached on disk
+            lazy_gitlab = LazyGitlab(acc_yaml_dict["gitlab"]["url"], GL_ADMIN_PRIVATE_TOKEN, logger)
+            gitlab_projects = GitlabProjectCache("{0}/{1}".format(CACHE_DIR, GITLAB_PROJECT_CACHE_FILE), GITLAB_PROJECT_CACHE_TTL, lazy_gitlab, logger)
 
-            # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            # Pipelines are created via GitLab API with the same session if asked
+            if args.native_pipelines:
+                pipeline_trigger = PipelineTrigger(lazy_gitlab, acc_yaml_dict["gitlab"].get("native_pipelines"), logger)
+            else:
+                pipeline_trigger = None
 
-                # Client file errors should not stop other clients
-                try:
-                
-                    logger.info("Found client file: {0}".format(client_file))
+            # Run jobs once or in loop with --daemon
+            while True:
 
-                    # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
-                    
-                    # Skip other clients
-                    if args.run_jobs:
-                        run_client, run_asset = args.run_jobs
-                    if args.run_job:
-                        run_client, run_asset, run_job = args.run_job
-                    if args.force_run_job:
-                        run_client, run_asset, run_job = args.force_run_job
-                    if args.force_run_jobs:
-                        run_client, run_asset = args.force_run_jobs
-
-                    if run_client != "ALL" and client_dict["name"].lower() != run_client:
-                        continue
+                # Earliest next due time of jobs for daemon, unknown if run failed before jobs were checked
+                next_due = None
 
-                    # Skip disabled clients
-                    if not client_dict["active"]:
-                        continue
+                # Run errors should not stop daemon, the next run starts after sleep
+                try:
 
-                    # Skip clients without salt_project
-                    if "salt_project" not in client_dict["gitlab"]:
-                        logger.info("Salt project not defined for client {client}, skipping".format(client=client_dict["name"]))
-                        continue
-                    
-                    # Skip clients with jobs disabled
-                    if "jobs_disabled" in client_dict and client_dict["jobs_disabled"] and not args.ignore_jobs_disabled:
-                        logger.info("Jos disabled for client {client}, skipping".format(client=client_dict["name"]))
-                        continue
+                    # Reconnect to PG if connection was lost, connection without shard lock is closed to try again on next run
+                    if conn.closed:
+                        conn = psycopg2.connect(dsn)
+                        cur = conn.cursor()
+                        if args.shard is not None:
+                            try:
+                                lock_shard(cur, shard, shards, logger)
+                            except Exception:
+                                conn.close()
+                                raise
+
+                    # Save now once in UTC
+                    # We cannot take now() within run jobs loops - each job run takes ~5 secs and thats why now drifts many minutes forward
+                    saved_now = datetime.now(pytz.timezone("UTC"))
+
+                    # Pipeline starts taken from quotas in this run, quota key -> count
+                    quota_used = collections.Counter()
+
+                    # Daemon full run each DAEMON_FULL_RUN seconds picks up job runs made by other processes
+                    full_run = not args.daemon or full_run_at is None or (saved_now - full_run_at).total_seconds() >= DAEMON_FULL_RUN
+                    if full_run:
+
+                        full_run_at = saved_now
+
+                        # Load last runs of all jobs of needed clients from jobs_log table in one query instead of query per job
+                        job_last_runs = load_job_last_runs(cur, last_run_client, logger)
+
+                        # Load jobs which are not due yet, all other jobs (due, new or with changed schedule) are evaluated
+                        if last_run_client == "ALL":
+                            sql = """
+                            SELECT
+                                    client
+                            ,       asset_fqdn
+                            ,       job_id
+                            ,       job_schedule
+                            ,       next_run_at
+                            FROM
+                                    jobs_next_run
+                            WHERE
+                                    next_run_at > %(now)s
+                            ;
+                            """
+                        else:
+                            sql = """
+                            SELECT
+                                    client
+                            ,       asset_fqdn
+                            ,       job_id
+                            ,       job_schedule
+                            ,       next_run_at
+                            FROM
+                                    jobs_next_run
+                            WHERE
+                                    next_run_at > %(now)s
+                            AND
+                                    LOWER(client) = %(client)s
+                            ;
+                            """
+                        logger.info("Query:")
+                        logger.info(sql)
+                        cur.execute(sql, {"client": last_run_client, "now": saved_now.replace(tzinfo=None)})
+                        job_next_runs = {}
+                        for row in cur:
+                            job_next_runs[(row[0], row[1], row[2])] = (row[3], pytz.timezone("UTC").localize(row[4]))
+                        logger.info("Loaded {count} job next runs not due yet".format(count=len(job_next_runs)))
 
-                    # Get GitLab project for client
-                    project = gl.projects.get(client_dict["gitlab"]["salt_project"]["path"])
-                    logger.info("Salt project {project} for client {client} ssh_url_to_repo: {ssh_url_to_repo}, path_with_namespace: {path_with_namespace}".format(project=client_dict["gitlab"]["salt_project"]["path"], client=client_dict["name"], path_with_namespace=project.path_with_namespace, ssh_url_to_repo=project.ssh_url_to_repo))
+                    else:
 
-                    asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
+                        # Load only due jobs, every evaluated job has next run saved, jobs waiting for quota are saved as due now
+                        if last_run_client == "ALL":
+                            sql = """
+                            SELECT
+                                    client
+                            ,       asset_fqdn
+                            ,       job_id
+                            FROM
+                                    jobs_next_run
+                            WHERE
+                                    next_run_at <= %(now)s
+                            ;
+                            """
+                        else:
+                            sql = """
+                            SELECT
+                                    client
+                            ,       asset_fqdn
+                            ,       job_id
+                            FROM
+                                    jobs_next_run
+                            WHERE
+                                    next_run_at <= %(now)s
+                            AND
+                                    LOWER(client) = %(client)s
+                            ;
+                            """
+                        logger.info("Query:")
+                        logger.info(sql)
+                        cur.execute(sql, {"client": last_run_client, "now": saved_now.replace(tzinfo=None)})
+                        due_jobs = set()
+                        due_assets = set()
+                        due_clients = set()
+                        for row in cur:
+                            due_jobs.add((row[0], row[1], row[2]))
+                            due_assets.add((row[0], row[1]))
+                            due_clients.add(row[0])
+                        logger.info("Loaded {count} due jobs".format(count=len(due_jobs)))
+
+                    # Work done per client in this run, client name -> counter of assets, jobs, triggered and seconds
+                    shard_stats = {}
+
+                    # For all clients
+                    for client_file in client_registry.files():
+
+                        client_started = timeit.default_timer()
+                        client_stats = None
+                        client_checked = False
+                        client_due_only = False
+
+                        # Client file errors should not stop other clients
+                        try:
 
-                    # For each asset
-                    for asset in asset_list:
+                            # Load client YAML
+                            client_dict = client_registry.load(client_file)
 
-                        # Asset errors should not stop other assets
-                        try:
+                            # Between full runs check only due jobs of client if its YAML and accounting YAML are the same, all its jobs have next runs saved then
+                            if not full_run:
+                                client_checked_entry = client_checked_yaml.get(client_file)
+                                if client_checked_entry is not None and client_checked_entry[0] is client_dict and client_checked_entry[1] is acc_yaml_dict:
+                                    if client_dict["name"] not in due_clients:
+                                        continue
+                                    client_due_only = True
+                            client_checked = True
+                    
+                            # Skip other clients
+                            if args.run_jobs:
+                                run_client, run_asset = args.run_jobs
+                            if args.run_job:
+                                run_client, run_asset, run_job = args.run_job
+                            if args.force_run_job:
+                                run_client, run_asset, run_job = args.force_run_job
+                            if args.force_run_jobs:
+                                run_client, run_asset = args.force_run_jobs
+
+                            if run_client != "ALL" and client_dict["name"].lower() != run_client:
+                                continue
 
-                            # Skip assets if needed
-                            if run_asset != "ALL" and asset["fqdn"] != run_asset:
+                            # Skip clients of other shards
+                            if args.shard is not None and not args.shard_by_asset and shard_of(client_dict["name"], shards) != shard:
                                 continue
 
-                            # Skip non-server assets
-                            if asset["kind"] != "server":
+                            # Skip disabled clients
+                            if not client_dict["active"]:
                                 continue
-                            
-                            # Skip assets with jobs disabled
-                            if "jobs_disabled" in asset and asset["jobs_disabled"] and not args.ignore_jobs_disabled:
-                                logger.info("Jos disabled for asset {asset}, skipping".format(asset=asset["fqdn"]))
+
+                            # Skip clients without salt_project
+                            if "salt_project" not in client_dict["gitlab"]:
+                                logger.info("Salt project not defined for client {client}, skipping".format(client=client_dict["name"]))
                                 continue
-                            
-                            # Skip not active assets
-                            if "active" in asset and not asset["active"]:
-                                logger.info("Asset {asset} is not active, skipping".format(asset=asset["fqdn"]))
+                    
+                            # Skip clients with jobs disabled
+                            if "jobs_disabled" in client_dict and client_dict["jobs_disabled"] and not args.ignore_jobs_disabled:
+                                logger.info("Jos disabled for client {client}, skipping".format(client=client_dict["name"]))
                                 continue
-                            
-                            # Build job list
-                            job_list = []
 
-                            # Print asset id
-                            print("Asset: {client} {asset_fqdn}".format(client=client_dict["name"], asset_fqdn=asset["fqdn"]))
+                            # GitLab project for client is taken when the first job of client is run
+                            project = None
 
-                            # Add global jobs from accounting yaml
-                            if "jobs" in acc_yaml_dict:
-                                
-                                for job_id, job_params in acc_yaml_dict["jobs"].items():
-                                    
-                                    # Do not add if the same job exists in client jobs or asset jobs
-                                    if not (("jobs" in client_dict and job_id in client_dict["jobs"]) or ("jobs" in asset and job_id in asset["jobs"])):
-                                        job_params["id"] = job_id
-                                        job_params["level"] = "GLOBAL"
-                                        job_list.append(job_params)
-
-                            # Add client jobs from client yaml
-                            if "jobs" in client_dict:
-                                
-                                for job_id, job_params in client_dict["jobs"].items():
-                                    
-                                    # Do not add if the same job exists in asset jobs
-                                    if not ("jobs" in asset and job_id in asset["jobs"]):
-                                        job_params["id"] = job_id
-                                        job_params["level"] = "CLIENT"
-                                        job_list.append(job_params)
-
-                            # Add asset jobs from asset def in client yaml
-                            if "jobs" in asset:
-                                
-                                for job_id, job_params in asset["jobs"].items():
-                                    job_params["id"] = job_id
-                                    job_params["level"] = "ASSET"
-                                    job_list.append(job_params)
+                            asset_list = get_asset_records(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
+                            client_stats = shard_stats.setdefault(client_dict["name"], collections.Counter())
 
-                            # Run jobs from job list
+                            # Global and client jobs are merged once per client, assets only add their own jobs
+                            job_table, job_table_built = get_job_table(acc_yaml_dict.get("jobs"), client_dict.get("jobs"))
+                            if job_table_built:
+                                logger.info("Job table for client {client}:".format(client=client_dict["name"]))
+                                logger.info(json.dumps(job_table.as_list(), indent=4, sort_keys=True))
 
-                            logger.info("Job list for asset {asset}:".format(asset=asset["fqdn"]))
-                            logger.info(json.dumps(job_list, indent=4, sort_keys=True))
+                            # For each asset
+                            for asset in asset_list:
 
-                            for job in job_list:
+                                # Asset errors should not stop other assets
+                                try:
 
-                                # Check os include
-                                if "os" in job and "include" in job["os"]:
-                                    if asset["os"] not in job["os"]["include"]:
-                                        logger.info("Job {asset}/{job} skipped because os {os} is not in job os include list".format(asset=asset["fqdn"], job=job["id"], os=asset["os"]))
+                                    # Skip assets if needed
+                                    if run_asset != "ALL" and asset.fqdn != run_asset:
                                         continue
 
-                                # Check os exclude
-                                if "os" in job and "exclude" in job["os"]:
-                                    if asset["os"] in job["os"]["exclude"]:
-                                        logger.info("Job {asset}/{job} skipped because os {os} is in job os exclude list".format(asset=asset["fqdn"], job=job["id"], os=asset["os"]))
+                                    # Skip assets without due jobs
+                                    if client_due_only and (client_dict["name"], asset.fqdn) not in due_assets:
                                         continue
 
-                                # Check job is disabled
-                                if "disabled" in job and job["disabled"]:
-                                    logger.info("Job {asset}/{job} skipped because it is disabled".format(asset=asset["fqdn"], job=job["id"]))
-                                    continue
+                                    # Skip assets of other shards
+                                    if args.shard is not None and args.shard_by_asset and shard_of(asset.fqdn, shards) != shard:
+                                        continue
 
-                                # Check licenses
-                                if "licenses" in job:
-                                    
-                                    logger.info("Job {asset}/{job} requires license list {lic_list_job}, loading licenses in tariffs".format(asset=asset["fqdn"], job=job["id"], lic_list_job=job["licenses"]))
+                                    # Skip non-server assets
+                                    if asset.kind != "server":
+                                        continue
+                            
+                                    # Skip assets with jobs disabled
+                                    if asset.jobs_disabled and not args.ignore_jobs_disabled:
+                                        logger.info("Jos disabled for asset {asset}, skipping".format(asset=asset.fqdn))
+                                        continue
+                            
+                                    # Skip not active assets
+                                    if not asset.active:
+                                        logger.info("Asset {asset} is not active, skipping".format(asset=asset.fqdn))
+                                        continue
+                            
+                                    # Print asset id
+                                    print("Asset: {client} {asset_fqdn}".format(client=client_dict["name"], asset_fqdn=asset.fqdn))
+                                    client_stats["assets"] += 1
 
-                                    # Load tariffs
+                                    # Job list from client job table and asset jobs
+                                    job_list = job_table.for_asset(asset.jobs)
 
-                                    # Take the first (upper and current) tariff
-                                    all_tar_lic_list = []
-                                    for asset_tariff in activated_tariff(asset["tariffs"], datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now(), logger)["tariffs"]:
+                                    # Run jobs from job list
 
-                                        # If tariff has file key - load it
-                                        if "file" in asset_tariff:
-                                            
-                                            tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
-                                            if tariff_dict is None:
-                                                
-                                                raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
+                                    logger.info("Job list for asset {asset}: {jobs}".format(asset=asset.fqdn, jobs=", ".join("{level}/{job}".format(level=job.level, job=job.id) for job in job_list)))
 
-                                            # Add tariff plan licenses to all tariffs lic list if exist
-                                            if "licenses" in tariff_dict:
-                                                all_tar_lic_list.extend(tariff_dict["licenses"])
+                                    for job in job_list:
 
-                                        # Also take inline plan and service
-                                        else:
+                                        # Skip jobs not due
+                                        if client_due_only and (client_dict["name"], asset.fqdn, str(job.id)) not in due_jobs:
+                                            continue
 
-                                            # Add tariff plan licenses to all tariffs lic list if exist
-                                            if "licenses" in asset_tariff:
-                                                all_tar_lic_list.extend(asset_tariff["licenses"])
+                                        # Check os, disabled and licenses
+                                        job_skip_reason = job_asset_skip_reason(asset, job)
+                                        if job_skip_reason is not None:
+                                            logger.info("Job {asset}/{job} skipped because {reason}".format(asset=asset.fqdn, job=job.id, reason=job_skip_reason))
+                                            continue
 
-                                    # Search for all needed licenses in tariff licenses and skip if not found
-                                    if not all(lic in all_tar_lic_list for lic in job["licenses"]):
-                                        logger.info("Job {asset}/{job} skipped because required license list {lic_list_job} is not found in joined licenses {lic_list_tar} of all of asset tariffs".format(asset=asset["fqdn"], job=job["id"], lic_list_job=job["licenses"], lic_list_tar=all_tar_lic_list))
-                                        continue
-                                    else:
-                                        logger.info("Job {asset}/{job} required license list {lic_list_job} is found in joined licenses {lic_list_tar} of all of asset tariffs".format(asset=asset["fqdn"], job=job["id"], lic_list_job=job["licenses"], lic_list_tar=all_tar_lic_list))
+                                        # Check run_job
+                                        if args.run_job:
+                                            if job.id != run_job:
+                                                logger.info("Job {asset}/{job} skipped because it is not needed job".format(asset=asset.fqdn, job=job.id))
+                                                continue
 
-                                # Check run_job
-                                if args.run_job:
-                                    if job["id"] != run_job:
-                                        logger.info("Job {asset}/{job} skipped because it is not needed job".format(asset=asset["fqdn"], job=job["id"]))
-                                        continue
+                                        client_stats["jobs"] += 1
 
-                                # Job error should not stop other jobs
-                                try:
+                                        # Skip jobs not due yet by jobs_next_run table without evaluating schedule, force runs omit time conditions
+                                        # Spread job is due the same way as by schedule shifted by its offset, offset is part of saved schedule
+                                        if not (args.force_run_job or args.force_run_jobs):
+                                            job_schedule = get_job_schedule(job.params, MINUTES_JITTER)
+                                            if args.spread:
+                                                job_offset = spread_offset(client_dict["name"], asset.fqdn, job.id)
+                                                job_schedule_text = "{fingerprint}+{offset}".format(fingerprint=job_schedule.fingerprint, offset=job_offset)
+                                            else:
+                                                job_offset = 0
+                                                job_schedule_text = job_schedule.fingerprint
+                                            job_next_run = job_next_runs.get((client_dict["name"], asset.fqdn, str(job.id)))
+                                            if job_next_run is not None and job_next_run[0] == job_schedule_text and job_next_run[1] > saved_now:
+                                                logger.info("Job {asset}/{job} skipped because it is not due until {time}".format(asset=asset.fqdn, job=job.id, time=datetime.strftime(job_next_run[1], "%Y-%m-%d %H:%M:%S %z %Z")))
+                                                if args.daemon and (next_due is None or job_next_run[1] < next_due):
+                                                    next_due = job_next_run[1]
+                                                continue
+
+                                        # Job error should not stop other jobs
+                                        try:
 
-                                    # Make now from saved_now in job timezone
-                                    now = saved_now.astimezone(pytz.timezone(job["tz"]))
-                                    logger.info("Job {asset}/{job} now() in job TZ is {now}".format(asset=asset["fqdn"], job=job["id"], now=datetime.strftime(now, "%Y-%m-%d %H:%M:%S %z %Z")))
-
-                                    # Load last job run from jobs_log table
-                                    sql = """
-                                    SELECT
-                                            jobs_script_run_at
-                                    ,       job_tz
-                                    FROM
-                                            jobs_log
-                                    WHERE
-                                            client = '{client}'
-                                    AND
-                                            asset_fqdn = '{asset_fqdn}'
-                                    AND
-                                            job_id = '{job_id}'
-                                    ORDER BY
-                                            id DESC
-                                    LIMIT 1
-                                    ;
-                                    """.format(client=client_dict["name"], asset_fqdn=asset["fqdn"], job_id=job["id"])
-                                    logger.info("Query:")
-                                    logger.info(sql)
-
-                                    cur.execute(sql)
-
-                                    # Get job last run
-                                    if cur.rowcount > 0:
-                                        row = cur.fetchone()
-                                        row_jobs_script_run_at = row[0]
-                                        row_job_tz = row[1]
-                                        row_offset = datetime.now(pytz.timezone(row_job_tz)).strftime("%z") # now is just for an object
-                                        job_last_run_text = datetime.strftime(row_jobs_script_run_at, "%Y-%m-%d %H:%M:%S") + " " + row_offset
-                                        job_last_run = datetime.strptime(job_last_run_text, "%Y-%m-%d %H:%M:%S %z")
-                                    else:
-                                        job_last_run = datetime.strptime("1970-01-01 00:00:00 +0000", "%Y-%m-%d %H:%M:%S %z")
-                                    logger.info("Job {asset}/{job} last run: {time}".format(asset=asset["fqdn"], job=job["id"], time=datetime.strftime(job_last_run, "%Y-%m-%d %H:%M:%S %z %Z")))
+                                            # Make now from saved_now in job timezone
+                                            now = saved_now.astimezone(pytz.timezone(job.tz))
+                                            logger.info("Job {asset}/{job} now() in job TZ is {now}".format(asset=asset.fqdn, job=job.id, now=datetime.strftime(now, "%Y-%m-%d %H:%M:%S %z %Z")))
+
+                                            # Get last job run from last runs loaded from jobs_log table
+                                            job_last_run_key = (client_dict["name"], asset.fqdn, str(job.id))
+                                            if job_last_run_key in job_last_runs:
+                                                row_jobs_script_run_at, row_job_tz = job_last_runs[job_last_run_key]
+                                                row_offset = datetime.now(pytz.timezone(row_job_tz)).strftime("%z") # now is just for an object
+                                                job_last_run_text = datetime.strftime(row_jobs_script_run_at, "%Y-%m-%d %H:%M:%S") + " " + row_offset
+                                                job_last_run = datetime.strptime(job_last_run_text, "%Y-%m-%d %H:%M:%S %z")
+                                            else:
+                                                job_last_run = datetime.strptime("1970-01-01 00:00:00 +0000", "%Y-%m-%d %H:%M:%S %z")
+                                            logger.info("Job {asset}/{job} last run: {time}".format(asset=asset.fqdn, job=job.id, time=datetime.strftime(job_last_run, "%Y-%m-%d %H:%M:%S %z %Z")))
                                     
-                                    # Check force run one job
+                                            # Check force run one job
 
-                                    if args.force_run_job:
+                                            if args.force_run_job:
 
-                                        if job["id"] != run_job:
-                                            logger.info("Job {asset}/{job} skipped because job id didn't match force run parameter".format(asset=asset["fqdn"], job=job["id"]))
-                                            continue
-                                        logger.info("Job {asset}/{job} force run - time conditions omitted".format(asset=asset["fqdn"], job=job["id"]))
-
-                                    # Check force run all jobs
-                                    elif args.force_run_jobs:
-
-                                        logger.info("Job {asset}/{job} force run - time conditions omitted".format(asset=asset["fqdn"], job=job["id"]))
-
-                                    else:
-
-                                        # Decide if needed to run
-
-                                        if "each" in job:
-                                            seconds_between_now_and_job_last_run = (now - job_last_run).total_seconds()
-                                            logger.info("Job {asset}/{job} seconds between now and job last run: {secs}".format(asset=asset["fqdn"], job=job["id"], secs=seconds_between_now_and_job_last_run))
-                                            seconds_needed_to_wait = 0-2*MINUTES_JITTER*60
-                                            if "years" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*24*365*job["each"]["years"]
-                                            if "months" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*24*31*job["each"]["month"]
-                                            if "weeks" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*24*7*job["each"]["weeks"]
-                                            if "days" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*24*job["each"]["days"]
-                                            if "hours" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*job["each"]["hours"]
-                                            if "minutes" in job["each"]:
-                                                seconds_needed_to_wait += 60*job["each"]["minutes"]
-                                            logger.info("Job {asset}/{job} seconds needed to wait from \"each\" key: {secs}".format(asset=asset["fqdn"], job=job["id"], secs=seconds_needed_to_wait))
-                                            if seconds_between_now_and_job_last_run < seconds_needed_to_wait:
-                                                logger.info("Job {asset}/{job} skipped because: {secs1} < {secs2}".format(asset=asset["fqdn"], job=job["id"], secs1=seconds_between_now_and_job_last_run, secs2=seconds_needed_to_wait))
-                                                continue
+                                                if job.id != run_job:
+                                                    logger.info("Job {asset}/{job} skipped because job id didn't match force run parameter".format(asset=asset.fqdn, job=job.id))
+                                                    continue
+                                                logger.info("Job {asset}/{job} force run - time conditions omitted".format(asset=asset.fqdn, job=job.id))
 
-                                        if "minutes" in job:
-                                            minutes_rewrited = []
-                                            for minutes in job["minutes"]:
-                                                if len(str(minutes).split("-")) > 1:
-                                                    for m in range(int(str(minutes).split("-")[0]), int(str(minutes).split("-")[1])+1):
-                                                        minutes_rewrited.append(m)
-                                                else:
-                                                    # Apply MINUTES_JITTER
-                                                    for m in range(int(minutes), int(minutes) + MINUTES_JITTER):
-                                                        minutes_rewrited.append(m)
-                                            logger.info("Job {asset}/{job} should be run on minutes: {mins}".format(asset=asset["fqdn"], job=job["id"], mins=minutes_rewrited))
-                                            now_minute = int(datetime.strftime(now, "%M"))
-                                            logger.info("Job {asset}/{job} now minute is: {minute}".format(asset=asset["fqdn"], job=job["id"], minute=now_minute))
-                                            if now_minute not in minutes_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now minute is not in run minutes list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
+                                            # Check force run all jobs
+                                            elif args.force_run_jobs:
+
+                                                logger.info("Job {asset}/{job} force run - time conditions omitted".format(asset=asset.fqdn, job=job.id))
+
+                                            else:
 
-                                        if "hours" in job:
-                                            hours_rewrited = []
-                                            for hours in job["hours"]:
-                                                if len(str(hours).split("-")) > 1:
-                                                    for h in range(int(str(hours).split("-")[0]), int(str(hours).split("-")[1])+1):
-                                                        hours_rewrited.append(h)
+                                                # Decide if needed to run, job schedule is compiled once per job
+                                                job_skip_reason = job_schedule.skip_reason(now - timedelta(minutes=job_offset), job_last_run)
+                                                if job_skip_reason is not None and job_offset > 0:
+                                                    job_skip_reason = "{reason} (schedule is spread by {offset} minutes)".format(reason=job_skip_reason, offset=job_offset)
+
+                                                # Daemon tries job not more often than each MINUTES_JITTER minutes as runs each 10 minutes did
+                                                if args.daemon:
+                                                    job_last_attempt = max(job_last_run, job_attempts.get(job_last_run_key, job_last_run))
+                                                    if job_skip_reason is None and (now - job_last_attempt).total_seconds() < MINUTES_JITTER*60:
+                                                        job_skip_reason = "it was tried less than {minutes} minutes ago".format(minutes=MINUTES_JITTER)
+
+                                                # Jobs over salt master or runner quota wait for next runs
+                                                job_quota_skip_reason = None
+                                                if job_skip_reason is None:
+                                                    job_quota_skip_reason = take_pipeline_quota(quota_used, job_quota_keys(client_dict, acc_yaml_dict, job, salt_master_quota, runner_quota))
+                                                    job_skip_reason = job_quota_skip_reason
+
+                                                # Job is not evaluated again before next run by schedule, job waiting for quota is saved as due now to be evaluated on next run
+                                                # Last run before this one is used for each key, so it is never later than real next run even if pipeline fails
+                                                if job_quota_skip_reason is None:
+                                                    job_next_run = job_schedule.next_run(now, job_last_run, job_offset)
+                                                    if job_next_run is not None:
+                                                        job_next_run = job_next_run.astimezone(pytz.timezone("UTC"))
                                                 else:
-                                                    hours_rewrited.append(int(hours))
-                                            logger.info("Job {asset}/{job} should be run on hours: {hours}".format(asset=asset["fqdn"], job=job["id"], hours=hours_rewrited))
-                                            now_hour = int(datetime.strftime(now, "%H"))
-                                            logger.info("Job {asset}/{job} now hour is: {hour}".format(asset=asset["fqdn"], job=job["id"], hour=now_hour))
-                                            if now_hour not in hours_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now hour is not in run hours list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-                                        
-                                        if "days" in job:
-                                            days_rewrited = []
-                                            for days in job["days"]:
-                                                if len(str(days).split("-")) > 1:
-                                                    for d in range(int(str(days).split("-")[0]), int(str(days).split("-")[1])+1):
-                                                        days_rewrited.append(d)
+                                                    job_next_run = saved_now
+                                                if job_next_run is not None:
+                                                    job_next_run_rows[job_last_run_key] = (
+                                                        client_dict["name"],
+                                                        asset.fqdn,
+                                                        str(job.id),
+                                                        job_schedule_text,
+                                                        job_next_run.replace(tzinfo=None)
+                                                    )
+                                                    job_next_runs[job_last_run_key] = (job_schedule_text, job_next_run)
+
+                                                if args.daemon:
+                                                    if job_skip_reason is None:
+                                                        job_attempts[job_last_run_key] = now
+                                                        job_last_attempt = now
+                                                    job_next_due = daemon_job_next_due(job_schedule, now, job_last_attempt, job_offset)
+                                                    if job_next_due is not None and (next_due is None or job_next_due < next_due):
+                                                        next_due = job_next_due
+
+                                                if job_skip_reason is not None:
+                                                    logger.info("Job {asset}/{job} skipped because {reason}".format(asset=asset.fqdn, job=job.id, reason=job_skip_reason))
+                                                    continue
+
+                                            # Run job
+
+                                            # Get GitLab project for client
+                                            if project is None:
+                                                project = gitlab_projects.get(client_dict["gitlab"]["salt_project"]["path"])
+                                                logger.info("Salt project {project} for client {client} ssh_url_to_repo: {ssh_url_to_repo}, path_with_namespace: {path_with_namespace}".format(project=client_dict["gitlab"]["salt_project"]["path"], client=client_dict["name"], path_with_namespace=project["path_with_namespace"], ssh_url_to_repo=project["ssh_url_to_repo"]))
+
+                                            if job.type == "salt_cmd":
+
+                                                if job.severity_override is not None:
+                                                    severity_override_part = "SEVERITY_OVERRIDE={severity_override}".format(severity_override=job.severity_override)
                                                 else:
-                                                    days_rewrited.append(int(days))
-                                            logger.info("Job {asset}/{job} should be run on days: {days}".format(asset=asset["fqdn"], job=job["id"], days=days_rewrited))
-                                            now_day = int(datetime.strftime(now, "%d"))
-                                            logger.info("Job {asset}/{job} now day is: {day}".format(asset=asset["fqdn"], job=job["id"], day=now_day))
-                                            if now_day not in days_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now day is not in run days list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-                                        
-                                        if "months" in job:
-                                            months_rewrited = []
-                                            for months in job["months"]:
-                                                if len(str(months).split("-")) > 1:
-                                                    for m in range(int(str(months).split("-")[0]), int(str(months).split("-")[1])+1):
-                                                        months_rewrited.append(m)
+                                                    severity_override_part = ""
+
+                                                if job.salt_ssh:
+                                                    salt_ssh_in_salt_part = "SALT_SSH_IN_SALT=true"
                                                 else:
-                                                    months_rewrited.append(int(months))
-                                            logger.info("Job {asset}/{job} should be run on months: {months}".format(asset=asset["fqdn"], job=job["id"], months=months_rewrited))
-                                            now_month = int(datetime.strftime(now, "%m"))
-                                            logger.info("Job {asset}/{job} now month is: {month}".format(asset=asset["fqdn"], job=job["id"], month=now_month))
-                                            if now_month not in months_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now month is not in run months list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-                                        
-                                        if "years" in job:
-                                            years_rewrited = []
-                                            for years in job["years"]:
-                                                if len(str(years).split("-")) > 1:
-                                                    for y in range(int(str(years).split("-")[0]), int(str(years).split("-")[1])+1):
-                                                        years_rewrited.append(y)
+                                                    salt_ssh_in_salt_part = ""
+
+                                                script = textwrap.dedent(
+                                                    """
+                                                    .gitlab-server-job/pipeline_salt_cmd.sh nowait {salt_project} {timeout} {asset} "{job_cmd}" {severity_override_part} {salt_ssh_in_salt_part}
+                                                    """
+                                                ).format(
+                                                    salt_project=client_dict["gitlab"]["salt_project"]["path"],
+                                                    timeout=job.timeout,
+                                                    asset=asset.fqdn,
+                                                    job_cmd=job.cmd,
+                                                    severity_override_part=severity_override_part,
+                                                    salt_ssh_in_salt_part=salt_ssh_in_salt_part
+                                                )
+
+                                                # Bash script is kept as fallback if pipeline is created via GitLab API
+                                                if pipeline_trigger is not None:
+                                                    logger.info("Triggering pipeline via GitLab API, fallback bash script:")
+                                                    logger.info(script)
+                                                    script = functools.partial(trigger_salt_cmd_pipeline, pipeline_trigger, client_dict["gitlab"]["salt_project"]["path"], asset.fqdn, job, script, logger)
+                                                    if not args.dry_run_pipeline and pipeline_pool is None:
+                                                        returncode = script()
+                                                        if returncode != 0:
+                                                            raise Exception("Pipeline script failed with exit code {code}".format(code=returncode))
                                                 else:
-                                                    years_rewrited.append(int(years))
-                                            logger.info("Job {asset}/{job} should be run on years: {years}".format(asset=asset["fqdn"], job=job["id"], years=years_rewrited))
-                                            now_year = int(datetime.strftime(now, "%Y"))
-                                            logger.info("Job {asset}/{job} now year is: {year}".format(asset=asset["fqdn"], job=job["id"], year=now_year))
-                                            if now_year not in years_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now year is not in run years list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
+                                                    logger.info("Running bash script:")
+                                                    logger.info(script)
+                                                    if not args.dry_run_pipeline and pipeline_pool is None:
+                                                        subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
+                                            elif job.type == "rsnapshot_backup_ssh":
                                         
-                                        if "weekdays" in job:
-                                            logger.info("Job {asset}/{job} should be run on weekdays: {weekdays}".format(asset=asset["fqdn"], job=job["id"], weekdays=job["weekdays"]))
-                                            now_weekday = datetime.strftime(now, "%a")
-                                            logger.info("Job {asset}/{job} now weekday is: {weekday}".format(asset=asset["fqdn"], job=job["id"], weekday=now_weekday))
-                                            if now_weekday not in job["weekdays"]:
-                                                logger.info("Job {asset}/{job} skipped because now weekday is not in run weekdays list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-
-                                    # Run job
-
-                                    if job["type"] == "salt_cmd":
-
-                                        if "severity_override" in job:
-                                            severity_override_part = "SEVERITY_OVERRIDE={severity_override}".format(severity_override=job["severity_override"])
-                                        else:
-                                            severity_override_part = ""
-
-                                        if "salt-ssh" in job and job["salt-ssh"]:
-                                            salt_ssh_in_salt_part = "SALT_SSH_IN_SALT=true"
-                                        else:
-                                            salt_ssh_in_salt_part = ""
-
-                                        script = textwrap.dedent(
-                                            """
-                                            .gitlab-server-job/pipeline_salt_cmd.sh nowait {salt_project} {timeout} {asset} "{job_cmd}" {severity_override_part} {salt_ssh_in_salt_part}
-                                            """
-                                        ).format(
-                                            salt_project=client_dict["gitlab"]["salt_project"]["path"],
-                                            timeout=job["timeout"],
-                                            asset=asset["fqdn"],
-                                            job_cmd=job["cmd"],
-                                            severity_override_part=severity_override_part,
-                                            salt_ssh_in_salt_part=salt_ssh_in_salt_part
-                                        )
-
-                                        logger.info("Running bash script:")
-                                        logger.info(script)
-                                        if not args.dry_run_pipeline:
-                                            subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
-                                    elif job["type"] == "rsnapshot_backup_ssh":
-                                        
-                                        # Decide which connect host:port to use
-                                        if "ssh" in asset:
-
-                                            if "host" in asset["ssh"]:
-                                                ssh_host = asset["ssh"]["host"]
-                                            else:
-                                                ssh_host = asset["fqdn"]
+                                                # Decide ssh jump, connect host:port are taken from asset record
+                                                if asset.ssh_jump is not None:
+                                                    ssh_jump = "SSH_JUMP={jump}".format(jump=asset.ssh_jump)
+                                                else:
+                                                    ssh_jump = ""
 
-                                            if "port" in asset["ssh"]:
-                                                ssh_port = asset["ssh"]["port"]
+                                                if job.salt_ssh:
+                                                    salt_ssh_in_salt_part = "SALT_SSH_IN_SALT=true"
+                                                else:
+                                                    salt_ssh_in_salt_part = ""
+
+                                                script = textwrap.dedent(
+                                                    """
+                                                    .gitlab-server-job/pipeline_rsnapshot_backup.sh nowait {salt_project} 0 {asset} SSH SSH_HOST={ssh_host} SSH_PORT={ssh_port} {ssh_jump} {salt_ssh_in_salt_part}
+                                                    """
+                                                ).format(
+                                                    salt_project=client_dict["gitlab"]["salt_project"]["path"],
+                                                    asset=asset.fqdn,
+                                                    ssh_host=asset.ssh_host,
+                                                    ssh_port=asset.ssh_port,
+                                                    ssh_jump=ssh_jump,
+                                                    salt_ssh_in_salt_part=salt_ssh_in_salt_part
+                                                )
+                                                logger.info("Running bash script:")
+                                                logger.info(script)
+                                                if not args.dry_run_pipeline and pipeline_pool is None:
+                                                    subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
+                                            elif job.type == "rsnapshot_backup_salt":
+
+                                                if job.salt_ssh:
+                                                    salt_ssh_in_salt_part = "SALT_SSH_IN_SALT=true"
+                                                else:
+                                                    salt_ssh_in_salt_part = ""
+
+                                                script = textwrap.dedent(
+                                                    """
+                                                    .gitlab-server-job/pipeline_rsnapshot_backup.sh nowait {salt_project} {timeout} {asset} SALT {salt_ssh_in_salt_part}
+                                                    """
+                                                ).format(
+                                                    salt_project=client_dict["gitlab"]["salt_project"]["path"],
+                                                    timeout=job.timeout,
+                                                    asset=asset.fqdn,
+                                                    salt_ssh_in_salt_part=salt_ssh_in_salt_part
+                                                )
+                                                logger.info("Running bash script:")
+                                                logger.info(script)
+                                                if not args.dry_run_pipeline and pipeline_pool is None:
+                                                    subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
                                             else:
-                                                ssh_port = "22"
-
-                                        else:
-
-                                            ssh_host = asset["fqdn"]
-                                            ssh_port = "22"
-
-                                        # Decide ssh jump
-                                        if "ssh" in asset and "jump" in asset["ssh"]:
-                                            ssh_jump = "SSH_JUMP={host}:{port}".format(host=asset["ssh"]["jump"]["host"], port=asset["ssh"]["jump"]["port"] if "port" in asset["ssh"]["jump"] else "22")
-                                        else:
-                                            ssh_jump = ""
-
-                                        if "salt-ssh" in job and job["salt-ssh"]:
-                                            salt_ssh_in_salt_part = "SALT_SSH_IN_SALT=true"
-                                        else:
-                                            salt_ssh_in_salt_part = ""
-
-                                        script = textwrap.dedent(
-                                            """
-                                            .gitlab-server-job/pipeline_rsnapshot_backup.sh nowait {salt_project} 0 {asset} SSH SSH_HOST={ssh_host} SSH_PORT={ssh_port} {ssh_jump} {salt_ssh_in_salt_part}
-                                            """
-                                        ).format(
-                                            salt_project=client_dict["gitlab"]["salt_project"]["path"],
-                                            asset=asset["fqdn"],
-                                            ssh_host=ssh_host,
-                                            ssh_port=ssh_port,
-                                            ssh_jump=ssh_jump,
-                                            salt_ssh_in_salt_part=salt_ssh_in_salt_part
-                                        )
-                                        logger.info("Running bash script:")
-                                        logger.info(script)
-                                        if not args.dry_run_pipeline:
-                                            subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
-                                    elif job["type"] == "rsnapshot_backup_salt":
-
-                                        if "salt-ssh" in job and job["salt-ssh"]:
-                                            salt_ssh_in_salt_part = "SALT_SSH_IN_SALT=true"
-                                        else:
-                                            salt_ssh_in_salt_part = ""
-
-                                        script = textwrap.dedent(
-                                            """
-                                            .gitlab-server-job/pipeline_rsnapshot_backup.sh nowait {salt_project} {timeout} {asset} SALT {salt_ssh_in_salt_part}
-                                            """
-                                        ).format(
-                                            salt_project=client_dict["gitlab"]["salt_project"]["path"],
-                                            timeout=job["timeout"],
-                                            asset=asset["fqdn"],
-                                            salt_ssh_in_salt_part=salt_ssh_in_salt_part
-                                        )
-                                        logger.info("Running bash script:")
-                                        logger.info(script)
-                                        if not args.dry_run_pipeline:
-                                            subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
-                                    else:
-                                        raise Exception("Unknown job type: {jtype}".format(jtype=job["type"]))
-
-                                    # Print job details
-                                    print(
-                                        "Job: {client} {asset_fqdn} {job_id} {job_level} {job_type} {job_cmd} {job_timeout}".format(
-                                            client=client_dict["name"],
-                                            asset_fqdn=asset["fqdn"],
-                                            job_id=job["id"],
-                                            job_level=job["level"],
-                                            job_type=job["type"],
-                                            job_cmd=job["cmd"].rstrip() if "cmd" in job else "",
-                                            job_timeout=job["timeout"] if "timeout" in job else ""
-                                        )
-                                    )
-
-                                    # Save job log
-                                    # r""" here to avoid SyntaxWarning: invalid escape sequence '\ '
-                                    sql = r"""
-                                    INSERT INTO
-                                            jobs_log
-                                            (
-                                                    jobs_script_run_at
-                                            ,       client
-                                            ,       asset_fqdn
-                                            ,       job_id
-                                            ,       job_level
-                                            ,       job_type
-                                            ,       job_cmd
-                                            ,       job_timeout
-                                            ,       job_tz
+                                                raise Exception("Unknown job type: {jtype}".format(jtype=job.type))
+
+                                            # Job details for output and job log
+                                            job_text = "Job: {client} {asset_fqdn} {job_id} {job_level} {job_type} {job_cmd} {job_timeout}".format(
+                                                client=client_dict["name"],
+                                                asset_fqdn=asset.fqdn,
+                                                job_id=job.id,
+                                                job_level=job.level,
+                                                job_type=job.type,
+                                                job_cmd=job.cmd.rstrip() if job.cmd is not None else "",
+                                                job_timeout=job.timeout if job.timeout is not None else ""
                                             )
-                                    VALUES
-                                            (
-                                                    '{jobs_script_run_at}'
-                                            ,       '{client}'
-                                            ,       '{asset_fqdn}'
-                                            ,       '{job_id}'
-                                            ,       '{job_level}'
-                                            ,       '{job_type}'
-                                            ,       TRIM(e'\t\n\r\ ' FROM CONVERT_FROM(DECODE('{job_cmd_base64}', 'BASE64'), 'UTF-8'))
-                                            ,       '{job_timeout}'
-                                            ,       '{job_tz}'
+                                            job_log_row = (
+                                                now.replace(tzinfo=None, microsecond=0),
+                                                client_dict["name"],
+                                                asset.fqdn,
+                                                str(job.id),
+                                                job.level,
+                                                job.type,
+                                                job.cmd.strip("\t\n\r ") if job.cmd is not None else "",
+                                                str(job.timeout) if job.timeout is not None else "",
+                                                job.tz
                                             )
-                                    ;
-                                    """.format(
-                                        jobs_script_run_at=datetime.strftime(now, "%Y-%m-%d %H:%M:%S"),
-                                        client=client_dict["name"],
-                                        asset_fqdn=asset["fqdn"],
-                                        job_id=job["id"],
-                                        job_level=job["level"],
-                                        job_type=job["type"],
-                                        job_cmd_base64=base64.b64encode(job["cmd"].encode("ascii")).decode("ascii") if "cmd" in job else "",
-                                        job_timeout=job["timeout"] if "timeout" in job else "",
-                                        job_tz=job["tz"]
-                                    )
-                                    logger.info("Query:")
-                                    logger.info(sql)
-                                    try:
-                                        cur.execute(sql)
-                                        logger.info("Query execution status:")
-                                        logger.info(cur.statusmessage)
-                                        conn.commit()
-                                    except Exception as e:
-                                        raise Exception("Caught exception on query execution")
+
+                                            # Pipeline script is run in pool, job is logged only if script finishes successfully
+                                            client_stats["triggered"] += 1
+                                            if pipeline_pool is not None and not args.dry_run_pipeline:
+                                                pipeline_triggers.append((pipeline_pool.submit(client_dict["gitlab"]["salt_project"]["path"], script), job_text, job_log_row, job_last_run_key))
+                                            else:
+                                                log_job_run(job_text, job_log_row, job_last_run_key, job_log_rows, job_last_runs)
+                                                if len(job_log_rows) >= JOBS_LOG_BATCH:
+                                                    save_jobs_log(conn, cur, job_log_rows, logger)
                                 
+                                        except Exception as e:
+                                            logger.error("Caught exception, but not interrupting")
+                                            logger.exception(e)
+                                            errors = True
+                
                                 except Exception as e:
                                     logger.error("Caught exception, but not interrupting")
                                     logger.exception(e)
                                     errors = True
-                
+
+                        except Exception as e:
+                            logger.error("Caught exception, but not interrupting")
+                            logger.exception(e)
+                            errors = True
+                            # Client is checked again on next run
+                            client_checked = False
+                            client_checked_yaml.pop(client_file, None)
+
+                        # Save job log rows of triggered pipelines even if interrupted
+                        # Rows failed to save are kept in buffers and saved with the next flush
+                        finally:
+                            if args.daemon and client_checked:
+                                client_checked_yaml[client_file] = (client_dict, acc_yaml_dict)
+                            if not collect_pipeline_triggers(pipeline_triggers, job_log_rows, job_last_runs, logger):
+                                errors = True
+                            try:
+                                save_jobs_log(conn, cur, job_log_rows, logger)
+                            except Exception as e:
+                                logger.error("Caught exception, but not interrupting")
+                                logger.exception(e)
+                                errors = True
+                            try:
+                                save_jobs_next_run(conn, cur, job_next_run_rows, logger)
+                            except Exception as e:
+                                logger.error("Caught exception, but not interrupting")
+                                logger.exception(e)
+                                errors = True
+                                # Due jobs are taken from DB between full runs, so unsaved next runs need full run
+                                full_run_at = None
+                            if client_stats is not None:
+                                client_stats["seconds"] += timeit.default_timer() - client_started
+
+                    # Wait for pipelines still running in pool
+                    if pipeline_pool is not None:
+                        if not collect_pipeline_triggers(pipeline_triggers, job_log_rows, job_last_runs, logger, True):
+                            errors = True
+                        try:
+                            save_jobs_log(conn, cur, job_log_rows, logger)
                         except Exception as e:
                             logger.error("Caught exception, but not interrupting")
                             logger.exception(e)
                             errors = True
 
+                    # Print shard work summary
+                    if args.shard is not None:
+                        print_shard_summary(shard, shards, shard_stats)
+
+                except Exception as e:
+                    if not args.daemon:
+                        raise
+                    logger.error("Caught exception, but not interrupting")
+                    logger.exception(e)
+                    errors = True
+                    # Job runs are loaded from DB and all clients are checked on next run
+                    full_run_at = None
+                    # Reset failed transaction, connection is closed if it is broken to reconnect on next run
+                    if not conn.closed:
+                        try:
+                            conn.rollback()
+                        except Exception:
+                            conn.close()
+
+                if not args.daemon:
+                    break
+
+                # Errors should not stop daemon
+                if errors:
+                    logger.error("There were errors, continuing")
+                    errors = False
+
+                # Sleep until the next due job, but not longer than DAEMON_MAX_SLEEP to pick up YAML changes
+                sleep_until = datetime.now(pytz.timezone("UTC")) + timedelta(seconds=DAEMON_MAX_SLEEP)
+                if next_due is not None and next_due < sleep_until:
+                    sleep_until = next_due
+                sleep_seconds = (sleep_until - datetime.now(pytz.timezone("UTC"))).total_seconds() + 1
+                logger.info("Sleeping {secs} seconds until {time}".format(secs=round(sleep_seconds), time=datetime.strftime(sleep_until, "%Y-%m-%d %H:%M:%S %z %Z")))
+                if sleep_seconds > 0:
+                    sleep(sleep_seconds)
+
+                # Reload only changed YAML, broken accounting YAML is loaded again on next run and the previous one is used until then
+                try:
+                    client_registry.refresh()
+                    # Changed tariffs could change job licenses of any client
+                    if refresh_tariff_cache(logger):
+                        full_run_at = None
+                    new_acc_yaml_mtime_ns = os.stat("{0}/{1}".format(WORK_DIR, ACC_YAML)).st_mtime_ns
+                    if new_acc_yaml_mtime_ns != acc_yaml_mtime_ns:
+                        new_acc_yaml_dict = load_yaml("{0}/{1}".format(WORK_DIR, ACC_YAML), logger)
+                        if new_acc_yaml_dict is None:
+                            raise Exception("Config file error or missing: {0}/{1}, keeping previously loaded".format(WORK_DIR, ACC_YAML))
+                        prune_global_job_caches(acc_yaml_dict.get("jobs"))
+                        acc_yaml_dict = new_acc_yaml_dict
+                        acc_yaml_mtime_ns = new_acc_yaml_mtime_ns
                 except Exception as e:
                     logger.error("Caught exception, but not interrupting")
                     logger.exception(e)
                     errors = True
 
+            # Wait for pool to finish
+            if pipeline_pool is not None:
+                pipeline_pool.shutdown()
+
             # Close connection
             cur.close()
             conn.close()
@@ -647,24 +1100,148 @@ if __name__ == "__main__":
             if errors:
                 raise Exception("There were errors")
 
+        if args.forecast:
+
+            # Quotas depend on order of clients and jobs within run, they are not modeled
+            if args.salt_master_quota is not None or args.runner_quota is not None:
+                raise Exception("--salt-master-quota and --runner-quota cannot be used with --forecast")
+
+            # Unpack window
+            forecast_window = []
+            for forecast_text in args.forecast:
+                if len(forecast_text) > len("YYYY-MM-DD"):
+                    forecast_window.append(pytz.timezone("UTC").localize(datetime.strptime(forecast_text, "%Y-%m-%d %H:%M")))
+                else:
+                    forecast_window.append(pytz.timezone("UTC").localize(datetime.strptime(forecast_text, "%Y-%m-%d")))
+            forecast_start, forecast_end = forecast_window
+            if forecast_start >= forecast_end:
+                raise Exception("--forecast START should be earlier than END")
+
+            # Daemon runs each minute and does not try job again within MINUTES_JITTER minutes, pipeline schedule runs each MINUTES_JITTER minutes
+            if args.forecast_step is not None:
+                forecast_step, = args.forecast_step
+                try:
+                    forecast_step = int(forecast_step)
+                except ValueError:
+                    raise Exception("--forecast-step MINUTES should be integer")
+                if not 1 <= forecast_step <= 60:
+                    raise Exception("--forecast-step MINUTES should be from 1 to 60")
+            else:
+                forecast_step = MINUTES_JITTER
+            forecast_gap = max(forecast_step, MINUTES_JITTER)
+
+            # Take job last runs from DB if it is configured, otherwise first hours get every job which can run at START
+            if all(os.environ.get(pg_var) is not None for pg_var in ["PG_DB_HOST", "PG_DB_PORT", "PG_DB_NAME", "PG_DB_USER", "PG_DB_PASS"]):
+                dsn = "host={host} port={port} dbname={dbname} user={user} password={password}".format(host=os.environ["PG_DB_HOST"], port=os.environ["PG_DB_PORT"], dbname=os.environ["PG_DB_NAME"], user=os.environ["PG_DB_USER"], password=os.environ["PG_DB_PASS"])
+                conn = psycopg2.connect(dsn)
+                try:
+                    job_last_runs = load_job_last_runs(conn.cursor(), "ALL", logger)
+                finally:
+                    conn.close()
+            else:
+                job_last_runs = None
+                forecast_warning = "Warning: PG_DB_* env vars are not set, jobs are assumed not run before START, so first hours of forecast are overstated"
+                logger.warning(forecast_warning)
+                print(forecast_warning, file=sys.stderr)
+
+            # Job runs by schedule, timezone and offset, computed once for all assets with the same job
+            forecast_runs = {}
+
+            # Number of assets per salt project and job runs key
+            forecast_assets = collections.Counter()
+
+            # For all clients
+            for client_file, client_dict in client_registry.items():
+
+                # Client file errors should not stop other clients
+                try:
+
+                    # Skip clients without jobs run
+                    if not client_dict["active"] or "salt_project" not in client_dict["gitlab"]:
+                        continue
+                    if "jobs_disabled" in client_dict and client_dict["jobs_disabled"] and not args.ignore_jobs_disabled:
+                        continue
+
+                    salt_project = client_dict["gitlab"]["salt_project"]["path"]
+                    job_table, job_table_built = get_job_table(acc_yaml_dict.get("jobs"), client_dict.get("jobs"))
+
+                    # For each asset as in run jobs, tariffs are taken at START
+                    for asset in get_asset_records(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, forecast_start.replace(tzinfo=None)):
+
+                        if asset.kind != "server" or not asset.active:
+                            continue
+                        if asset.jobs_disabled and not args.ignore_jobs_disabled:
+                            continue
+
+                        for job in job_table.for_asset(asset.jobs):
+
+                            if job_asset_skip_reason(asset, job) is not None:
+                                continue
+
+                            job_schedule = get_job_schedule(job.params, MINUTES_JITTER)
+                            if args.spread:
+                                job_offset = spread_offset(client_dict["name"], asset.fqdn, job.id)
+                            else:
+                                job_offset = 0
+
+                            # Last run matters only if it is within gap or each interval before START, runs after START are not known at START
+                            job_last_run = None
+                            if job_last_runs is not None and (client_dict["name"], asset.fqdn, str(job.id)) in job_last_runs:
+                                row_jobs_script_run_at, row_job_tz = job_last_runs[(client_dict["name"], asset.fqdn, str(job.id))]
+                                job_last_run = pytz.timezone(row_job_tz).localize(row_jobs_script_run_at.replace(second=0, microsecond=0)).astimezone(pytz.timezone("UTC"))
+                                job_last_run_matters = job_last_run + timedelta(minutes=forecast_gap) > forecast_start
+                                if job_schedule.interval is not None and job_last_run + timedelta(seconds=job_schedule.interval) > forecast_start:
+                                    job_last_run_matters = True
+                                if job_last_run >= forecast_start or not job_last_run_matters:
+                                    job_last_run = None
+
+                            forecast_key = (id(job_schedule), job.tz, job_offset, job_last_run)
+                            if forecast_key not in forecast_runs:
+                                forecast_runs[forecast_key] = forecast_job_runs(job_schedule, pytz.timezone(job.tz), job_offset, forecast_start, forecast_end, forecast_step, forecast_gap, job_last_run)
+                            forecast_assets[(salt_project, forecast_key)] += 1
+                            if args.debug:
+                                job_runs = forecast_runs[forecast_key]
+                                logger.info("Job {client}/{asset}/{job} forecast runs {count}, first at {first} UTC".format(
+                                    client=client_dict["name"], asset=asset.fqdn, job=job.id, count=len(job_runs),
+                                    first=datetime.strftime(job_runs[0], "%Y-%m-%d %H:%M") if len(job_runs) > 0 else "never"
+                                ))
+
+                except Exception as e:
+                    logger.error("Caught exception, but not interrupting")
+                    logger.exception(e)
+                    errors = True
+
+            # Count pipelines per hour per salt project
+            forecast_hours = {}
+            for (salt_project, forecast_key), asset_count in forecast_assets.items():
+                for job_run in forecast_runs[forecast_key]:
+                    hour_counts = forecast_hours.setdefault(job_run.replace(minute=0), collections.Counter())
+                    hour_counts[salt_project] += asset_count
+
+            # Print hour, salt project and count, TOTAL for all salt projects
+            for hour, hour_counts in sorted(forecast_hours.items()):
+                for salt_project, count in sorted(hour_counts.items()):
+                    print("{hour}\t{project}\t{count}".format(hour=datetime.strftime(hour, "%Y-%m-%d %H:00"), project=salt_project, count=count))
+                print("{hour}\t{project}\t{count}".format(hour=datetime.strftime(hour, "%Y-%m-%d %H:00"), project="TOTAL", count=sum(hour_counts.values())))
+
+            # Exit with error if there were errors
+            if errors:
+                raise Exception("There were errors")
+
         if args.prune_run_tags:
             
             # Connect to GitLab
             gl = gitlab.Gitlab(acc_yaml_dict["gitlab"]["url"], private_token=GL_ADMIN_PRIVATE_TOKEN)
             gl.auth()
 
-            # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            # For all clients
+            for client_file in client_registry.files():
 
                 # Client file errors should not stop other clients
                 try:
-                
-                    logger.info("Found client file: {0}".format(client_file))
 
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                    client_dict = client_registry.load(client_file)
                     
                     # Skip other clients
                     prune_client, prune_age = args.prune_run_tags
@@ -727,7 +1304,9 @@ if __name__ == "__main__":
     # Reroute catched exception to log
     except Exception as e:
         logger.exception(e)
+        log_tariff_cache_stats(logger)
         logger.info("Finished {LOGO} with errors".format(LOGO=LOGO))
         sys.exit(1)
 
+    log_tariff_cache_stats(logger)
     logger.info("Finished {LOGO}".format(LOGO=LOGO))
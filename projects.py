@@ -22,6 +22,7 @@ import shutil
 LOGO="Projects"
 WORK_DIR = os.environ.get("ACC_WORKDIR", "/opt/sysadmws/accounting")
 LOG_DIR = os.environ.get("ACC_LOGDIR", "/opt/sysadmws/accounting/log")
+CACHE_DIR = os.environ.get("ACC_CACHEDIR", "/opt/sysadmws/accounting/cache")
 LOG_FILE = "projects.log"
 TARIFFS_SUBDIR = "tariffs"
 CLIENTS_SUBDIR = "clients"
@@ -58,6 +59,7 @@ if __name__ == "__main__":
     parser.add_argument("--dry-run-gitlab", dest="dry_run_gitlab", help="no new objects created in gitlab", action="store_true")
     parser.add_argument("--gitlab-runner-registration-token", dest="gitlab_runner_registration_token", help="set gitlab runner registration token for template if you do not have maintainer rights to get it with code", nargs=1, metavar=("TOKEN"))
     parser.add_argument("--at-date", dest="at_date", help="use DATETIME instead of now for tariff", nargs=1, metavar=("DATETIME"))
+    parser.add_argument("--workers", dest="workers", help="load client yamls with includes in N parallel processes", nargs=1, metavar=("N"))
     parser.add_argument("--issue", dest="issue", help="do list/comment operations for issues", action="store_true")
     parser.add_argument("--mr", dest="mr", help="do list/comment operations for MRs", action="store_true")
     parser.add_argument("--include-closed", dest="include_closed", help="include closed issues/MRs in lists", action="store_true")
@@ -132,13 +134,21 @@ if __name__ == "__main__":
             json_str, = args.exclude_clients
             exclude_clients_list = json.loads(json_str)
         else:
-            exclude_clients_list = []
+            exclude_clients_list = None
 
         if args.include_clients is not None:
             json_str, = args.include_clients
             include_clients_list = json.loads(json_str)
         else:
-            include_clients_list = []
+            include_clients_list = None
+
+        # Each client is loaded once per run and shared by all loops below
+        client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, YAML_EXT, logger, CACHE_DIR, exclude_clients_list, include_clients_list)
+
+        # Load clients in parallel if asked
+        if args.workers is not None:
+            workers, = args.workers
+            client_registry.preload(int(workers))
 
         if args.setup_projects_for_client is not None or args.setup_projects_for_all_clients:
             
@@ -146,15 +156,8 @@ if __name__ == "__main__":
             gl = gitlab.Gitlab(acc_yaml_dict["gitlab"]["url"], private_token=GL_ADMIN_PRIVATE_TOKEN)
             gl.auth()
 
-            # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
-
-                logger.info("Found client file: {0}".format(client_file))
-
-                # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            # For all clients
+            for client_file, client_dict in client_registry.items():
                 
                 # Check specific client
                 if args.setup_projects_for_client is not None:
@@ -166,25 +169,7 @@ if __name__ == "__main__":
                 if (
                         client_dict["active"]
                         and
-                        (
-                            (
-                                args.exclude_clients is not None
-                                and
-                                client_dict["name"].lower() not in exclude_clients_list
-                            )
-                            or
-                            (
-                                args.include_clients is not None
-                                and
-                                client_dict["name"].lower() in include_clients_list
-                            )
-                            or
-                            (
-                                args.exclude_clients is None
-                                and
-                                args.include_clients is None
-                            )
-                        )
+                        client_registry.selected(client_dict)
                     ):
             
                     # Salt Project
@@ -365,15 +350,8 @@ if __name__ == "__main__":
             gl = gitlab.Gitlab(acc_yaml_dict["gitlab"]["url"], private_token=GL_ADMIN_PRIVATE_TOKEN)
             gl.auth()
 
-            # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
-
-                logger.info("Found client file: {0}".format(client_file))
-
-                # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            # For all clients
+            for client_file, client_dict in client_registry.items():
                 
                 # Check specific client
                 if args.clone_project_for_client is not None:
@@ -387,25 +365,7 @@ if __name__ == "__main__":
                         and
                         "salt_project" in client_dict["gitlab"]
                         and
-                        (
-                            (
-                                args.exclude_clients is not None
-                                and
-                                client_dict["name"].lower() not in exclude_clients_list
-                            )
-                            or
-                            (
-                                args.include_clients is not None
-                                and
-                                client_dict["name"].lower() in include_clients_list
-                            )
-                            or
-                            (
-                                args.exclude_clients is None
-                                and
-                                args.include_clients is None
-                            )
-                        )
+                        client_registry.selected(client_dict)
                     ):
             
                     # Get GitLab project for client
@@ -452,15 +412,8 @@ if __name__ == "__main__":
             gl = gitlab.Gitlab(acc_yaml_dict["gitlab"]["url"], private_token=GL_ADMIN_PRIVATE_TOKEN)
             gl.auth()
 
-            # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
-
-                logger.info("Found client file: {0}".format(client_file))
-
-                # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            # For all clients
+            for client_file, client_dict in client_registry.items():
                 
                 # Check specific client
                 if args.template_salt_project_for_client is not None:
@@ -474,25 +427,7 @@ if __name__ == "__main__":
                         and
                         "salt_project" in client_dict["gitlab"]
                         and
-                        (
-                            (
-                                args.exclude_clients is not None
-                                and
-                                client_dict["name"].lower() not in exclude_clients_list
-                            )
-                            or
-                            (
-                                args.include_clients is not None
-                                and
-                                client_dict["name"].lower() in include_clients_list
-                            )
-                            or
-                            (
-                                args.exclude_clients is None
-                                and
-                                args.include_clients is None
-                            )
-                        )
+                        client_registry.selected(client_dict)
                     ):
             
                     # Get GitLab project for client
@@ -560,13 +495,8 @@ if __name__ == "__main__":
                     # Check sub_clients before adding
                     if "sub_clients" in client_dict["configuration_management"]:
 
-                        # For *.yaml in client dir
-                        for template_var_client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
-
-                            # Load client YAML
-                            template_var_client_dict = load_client_yaml(WORK_DIR, template_var_client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                            if template_var_client_dict is None:
-                                raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, template_var_client_file))
+                        # For all clients, already loaded ones are reused
+                        for template_var_client_file, template_var_client_dict in client_registry.items():
 
                             if template_var_client_dict["active"]:
 
@@ -1129,15 +1059,8 @@ if __name__ == "__main__":
             gl = gitlab.Gitlab(acc_yaml_dict["gitlab"]["url"], private_token=GL_ADMIN_PRIVATE_TOKEN)
             gl.auth()
 
-            # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
-
-                logger.info("Found client file: {0}".format(client_file))
-
-                # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            # For all clients
+            for client_file, client_dict in client_registry.items():
 
                 # Check specific client
                 if args.update_admin_project_wiki_for_client is not None:
@@ -1151,25 +1074,7 @@ if __name__ == "__main__":
                         and
                         "admin_project" in client_dict["gitlab"]
                         and
-                        (
-                            (
-                                args.exclude_clients is not None
-                                and
-                                client_dict["name"].lower() not in exclude_clients_list
-                            )
-                            or
-                            (
-                                args.include_clients is not None
-                                and
-                                client_dict["name"].lower() in include_clients_list
-                            )
-                            or
-                            (
-                                args.exclude_clients is None
-                                and
-                                args.include_clients is None
-                            )
-                        )
+                        client_registry.selected(client_dict)
                     ):
             
                     # Get GitLab project for client
@@ -1375,15 +1280,8 @@ if __name__ == "__main__":
             gl = gitlab.Gitlab(acc_yaml_dict["gitlab"]["url"], private_token=GL_ADMIN_PRIVATE_TOKEN)
             gl.auth()
 
-            # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
-
-                logger.info("Found client file: {0}".format(client_file))
-
-                # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            # For all clients
+            for client_file, client_dict in client_registry.items():
                 
                 # Check specific client
                 if client != "ALL":
@@ -1394,25 +1292,7 @@ if __name__ == "__main__":
                 if (
                         client_dict["active"]
                         and
-                        (
-                            (
-                                args.exclude_clients is not None
-                                and
-                                client_dict["name"].lower() not in exclude_clients_list
-                            )
-                            or
-                            (
-                                args.include_clients is not None
-                                and
-                                client_dict["name"].lower() in include_clients_list
-                            )
-                            or
-                            (
-                                args.exclude_clients is None
-                                and
-                                args.include_clients is None
-                            )
-                        )
+                        client_registry.selected(client_dict)
                     ):
             
                     project_list = []
@@ -1550,7 +1430,9 @@ if __name__ == "__main__":
     # Reroute catched exception to log
     except Exception as e:
         logger.exception(e)
+        log_tariff_cache_stats(logger)
         logger.info("Finished {LOGO} with errors".format(LOGO=LOGO))
         sys.exit(1)
 
+    log_tariff_cache_stats(logger)
     logger.info("Finished {LOGO}".format(LOGO=LOGO))
@@ -11,9 +11,7 @@ import paramiko
 import sys
 import json
 from io import BytesIO
-import threading
 import re
-import time
 from datetime import datetime
 
 # Constants and envs
@@ -21,12 +19,67 @@ from datetime import datetime
 LOGO="Services"
 WORK_DIR = os.environ.get("ACC_WORKDIR", "/opt/sysadmws/accounting")
 LOG_DIR = os.environ.get("ACC_LOGDIR", "/opt/sysadmws/accounting/log")
+CACHE_DIR = os.environ.get("ACC_CACHEDIR", "/opt/sysadmws/accounting/cache")
 LOG_FILE = "services.log"
 CLIENTS_SUBDIR = "clients"
 TARIFFS_SUBDIR = "tariffs"
 YAML_GLOB = "*.yaml"
 YAML_EXT = "yaml"
 ACC_YAML = "accounting.yaml"
+SALT_CMD_TIMEOUT = 300 # Salt cmd timeout passed to pipelines
+PIPELINE_WAIT_TIMEOUT = 1800 # How long to wait for pipelines created via GitLab API to finish
+PIPELINE_RATE = 0.25 # Pipelines created per second by default, the same as one pipeline each 4 seconds
+PIPELINE_BURST = 1 # Pipelines created at once by default
+PIPELINE_MAX_IN_FLIGHT = 100 # Pipelines not finished yet by default, this is the number of worker threads
+ROLLOUT_GROWTH = 2 # Each rollout wave is this times bigger than previous by default
+ROLLOUT_FAILURE_THRESHOLD = 0 # Percent of failed pipelines in wave to abort rollout by default, any failure aborts
+
+# Funcs
+
+# Value at percent of sorted values by nearest rank, None if no values
+def percentile(sorted_values, percent):
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[max(0, -(-len(sorted_values)*percent // 100) - 1)]
+
+# Order targets round robin by salt project, so each wave hits as many salt projects as possible
+def interleave_targets(targets):
+    by_project = OrderedDict()
+    for target in targets:
+        by_project.setdefault(target[1], collections.deque()).append(target)
+    interleaved = []
+    while len(by_project) > 0:
+        for salt_project in list(by_project.keys()):
+            interleaved.append(by_project[salt_project].popleft())
+            if len(by_project[salt_project]) == 0:
+                del by_project[salt_project]
+    return interleaved
+
+# Split targets into canary wave and waves growing geometrically by growth
+def rollout_waves(targets, canary, growth):
+    waves = []
+    wave_size = canary
+    position = 0
+    while position < len(targets):
+        waves.append(targets[position:position+int(wave_size)])
+        position += int(wave_size)
+        wave_size = max(wave_size + 1, wave_size*growth)
+    return waves
+
+# Print summary of pipeline results as JSON line: count per status, p50/p95 duration in seconds, returns number of failed pipelines
+def print_pipeline_summary(results):
+    statuses = collections.Counter(result["pipeline_status"] for result in results)
+    durations = sorted(result["duration"] for result in results if result["duration"] is not None)
+    print(json.dumps({
+        "summary": {
+            "total": len(results),
+            "statuses": dict(statuses),
+            "duration_p50": percentile(durations, 50),
+            "duration_p95": percentile(durations, 95)
+        }
+    }, sort_keys=True))
+    sys.stdout.flush()
+    return len(results) - statuses["success"]
 
 # Main
 
@@ -44,10 +97,21 @@ if __name__ == "__main__":
                           help="ignore jobs_disabled if set in yaml",
                           action="store_true")
     parser.add_argument("--at-date", dest="at_date", help="use DATETIME instead of now for tariff", nargs=1, metavar=("DATETIME"))
+    parser.add_argument("--workers", dest="workers", help="load client yamls with includes in N parallel processes", nargs=1, metavar=("N"))
     parser.add_argument("--salt-ssh",
                           dest="salt_ssh",
                           help="use salt-ssh in salt, applicable to projects with minions",
                           action="store_true")
+    parser.add_argument("--native-pipelines",
+                          dest="native_pipelines",
+                          help="create pipelines via GitLab API instead of pipeline_salt_cmd.sh with ref and variable names from gitlab:native_pipelines of accounting yaml, script is still used if salt project cannot be taken via API",
+                          action="store_true")
+    parser.add_argument("--rate", dest="rate", help="create at most N pipelines per second, default {0}".format(PIPELINE_RATE), nargs=1, metavar=("N"))
+    parser.add_argument("--burst", dest="burst", help="create up to N pipelines at once if rate allows, default {0}".format(PIPELINE_BURST), nargs=1, metavar=("N"))
+    parser.add_argument("--canary", dest="canary", help="roll out in waves: first run pipelines for N assets, then for waves growing by --wave-growth while failures are within --failure-threshold", nargs=1, metavar=("N"))
+    parser.add_argument("--wave-growth", dest="wave_growth", help="make each rollout wave FACTOR times bigger than previous, default {0}".format(ROLLOUT_GROWTH), nargs=1, metavar=("FACTOR"))
+    parser.add_argument("--failure-threshold", dest="failure_threshold", help="abort remaining rollout waves if more than PERCENT of wave pipelines fail, default {0}".format(ROLLOUT_FAILURE_THRESHOLD), nargs=1, metavar=("PERCENT"))
+    parser.add_argument("--max-in-flight", dest="max_in_flight", help="have at most N pipelines not finished yet, default {0}".format(PIPELINE_MAX_IN_FLIGHT), nargs=1, metavar=("N"))
 
     group = parser.add_mutually_exclusive_group(required=False)
     group.add_argument("--exclude-clients",
@@ -108,25 +172,114 @@ if __name__ == "__main__":
             json_str, = args.exclude_clients
             exclude_clients_list = json.loads(json_str)
         else:
-            exclude_clients_list = []
+            exclude_clients_list = None
 
         if args.include_clients is not None:
             json_str, = args.include_clients
             include_clients_list = json.loads(json_str)
         else:
-            include_clients_list = []
+            include_clients_list = None
+
+        # Each client is loaded once per run and shared by all loops below
+        client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, YAML_EXT, logger, CACHE_DIR, exclude_clients_list, include_clients_list)
+
+        # Load clients in parallel if asked
+        if args.workers is not None:
+            workers, = args.workers
+            client_registry.preload(int(workers))
 
         if args.pipeline_salt_cmd_for_asset_for_client or args.pipeline_salt_cmd_for_all_assets_for_client or args.pipeline_salt_cmd_for_all_assets_for_all_clients:
-            
-            # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
 
-                logger.info("Found client file: {0}".format(client_file))
+            # One GitLab connection for all pipelines created via API
+            if args.native_pipelines:
+                GL_ADMIN_PRIVATE_TOKEN = os.environ.get("GL_ADMIN_PRIVATE_TOKEN")
+                if GL_ADMIN_PRIVATE_TOKEN is None:
+                    raise Exception("Env var GL_ADMIN_PRIVATE_TOKEN missing")
+                pipeline_trigger = PipelineTrigger(LazyGitlab(acc_yaml_dict["gitlab"]["url"], GL_ADMIN_PRIVATE_TOKEN, logger), acc_yaml_dict["gitlab"].get("native_pipelines"), logger)
+
+            # Pipelines are created not faster than rate with bursts, instead of fixed sleep between them
+            if args.rate is not None:
+                rate, = args.rate
+                rate = float(rate)
+            else:
+                rate = PIPELINE_RATE
+            if args.burst is not None:
+                burst, = args.burst
+                burst = int(burst)
+            else:
+                burst = PIPELINE_BURST
+            rate_limiter = TokenBucket(rate, burst)
+
+            # Pipelines not finished yet are limited by number of workers
+            if args.max_in_flight is not None:
+                max_in_flight, = args.max_in_flight
+                max_in_flight = int(max_in_flight)
+            else:
+                max_in_flight = PIPELINE_MAX_IN_FLIGHT
+
+            if args.salt_ssh:
+                salt_ssh_in_salt_part = "SALT_SSH_IN_SALT=true"
+                pipeline_variables = {"SALT_SSH_IN_SALT": "true"}
+            else:
+                salt_ssh_in_salt_part = ""
+                pipeline_variables = {}
+
+            # Worker function, run pipeline for one asset, wait for it and return result
+            # Result has the same keys as pipeline_salt_cmd.sh json output plus client, error and duration in seconds
+            def pipeline_salt_cmd(client, salt_project, asset, cmd):
+
+                try:
+
+                    # Create pipeline via GitLab API, script is used only if nothing was created in GitLab yet
+                    result = None
+                    if args.native_pipelines:
+                        rate_limiter.acquire()
+                        started = timeit.default_timer()
+                        result, = pipeline_trigger.trigger_batch(salt_project, [(asset, cmd, SALT_CMD_TIMEOUT, pipeline_variables)])
+                        if result.pop("fallback"):
+                            result = None
+                        else:
+                            if result["pipeline_id"] is not None:
+                                pipeline_trigger.wait([result], PIPELINE_WAIT_TIMEOUT)
+                            else:
+                                result["pipeline_status"] = "error"
+                            result["duration"] = round(timeit.default_timer() - started, 1)
+
+                    if result is None:
+                        script = textwrap.dedent(
+                            """
+                            .gitlab-server-job/pipeline_salt_cmd.sh wait {salt_project} {timeout} {asset} "{cmd}" {salt_ssh_in_salt_part}
+                            """
+                        ).format(
+                            salt_project=salt_project,
+                            timeout=SALT_CMD_TIMEOUT,
+                            asset=asset,
+                            cmd=cmd,
+                            salt_ssh_in_salt_part=salt_ssh_in_salt_part
+                        )
+                        rate_limiter.acquire()
+                        started = timeit.default_timer()
+                        logger.info("Running bash script in thread:")
+                        logger.info(script)
+                        run_result = subprocess.run(script, shell=True, universal_newlines=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                        result = json.loads(run_result.stdout.rstrip())
+                        # Take last line as error
+                        result["error"] = run_result.stderr.rstrip().split("\n")[-1] if result.get("pipeline_status") != "success" else ""
+                        result["duration"] = round(timeit.default_timer() - started, 1)
+
+                # Worker errors are results as well
+                except Exception as e:
+                    logger.exception(e)
+                    result = {"project": salt_project, "target": asset, "pipeline_url": "", "pipeline_status": "error", "error": str(e), "duration": None}
+
+                result["client"] = client
+                return result
 
-                # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            # Pipeline targets of all clients: client, salt project, asset, cmd
+            targets = []
+
+            # For all clients
+            for client_file, client_dict in client_registry.items():
                 
                 # Unpack oarams and select client if needed
                 needed_asset = None
@@ -145,25 +298,7 @@ if __name__ == "__main__":
                 if (
                         client_dict["active"] and "salt_project" in client_dict["gitlab"] and client_dict["configuration_management"]["type"] in ["salt", "salt-ssh"]
                         and
-                        (
-                            (
-                                args.exclude_clients is not None
-                                and
-                                client_dict["name"].lower() not in exclude_clients_list
-                            )
-                            or
-                            (
-                                args.include_clients is not None
-                                and
-                                client_dict["name"].lower() in include_clients_list
-                            )
-                            or
-                            (
-                                args.exclude_clients is None
-                                and
-                                args.include_clients is None
-                            )
-                        )
+                        client_registry.selected(client_dict)
                     ):
 
                     # Skip clients with global jobs disabled
@@ -172,42 +307,6 @@ if __name__ == "__main__":
             
                     asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
 
-                    # Threaded function
-                    def pipeline_salt_cmd(salt_project, asset, cmd):
-
-                        if args.salt_ssh:
-                            salt_ssh_in_salt_part = "SALT_SSH_IN_SALT=true"
-                        else:
-                            salt_ssh_in_salt_part = ""
-
-                        script = textwrap.dedent(
-                            """
-                            .gitlab-server-job/pipeline_salt_cmd.sh wait {salt_project} 300 {asset} "{cmd}" {salt_ssh_in_salt_part}
-                            """
-                        ).format(
-                            salt_project=salt_project,
-                            asset=asset,
-                            cmd=cmd,
-                            salt_ssh_in_salt_part=salt_ssh_in_salt_part
-                        )
-                        logger.info("Running bash script in thread:")
-                        logger.info(script)
-                        run_result = subprocess.run(script, shell=True, universal_newlines=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                        json_result = json.loads(run_result.stdout.rstrip())
-                        # Take last line as error
-                        result_error=run_result.stderr.rstrip().split("\n")[-1]
-                        result_pipeline_status=json_result.get("pipeline_status", "")
-                        result_project=json_result.get("project", "")
-                        result_target=json_result.get("target", "")
-                        result_url=json_result.get("pipeline_url", "")
-                        print("{status}\t{project}\t{target}\t{url}\t{error}".format(
-                            status=result_pipeline_status,
-                            project=result_project,
-                            target=result_target,
-                            url=result_url,
-                            error=result_error if result_pipeline_status != "success" else ""
-                        ))
-
                     # For each asset
                     for asset in asset_list:
                         
@@ -223,16 +322,69 @@ if __name__ == "__main__":
                                 if needed_asset != asset["fqdn"]:
                                     continue
 
-                            # Run pipeline
-                            thread = threading.Thread(target=pipeline_salt_cmd, args=[client_dict["gitlab"]["salt_project"]["path"], asset["fqdn"], cmd])
-                            thread.start()
-                            # Give gitlab time to create tag and pipeline, otherwise it will be overloaded
-                            time.sleep(4)
+                            targets.append((client_dict["name"], client_dict["gitlab"]["salt_project"]["path"], asset["fqdn"], cmd))
+
+            # Waves of targets, without rollout all targets are one wave
+            if args.canary is not None:
+                canary, = args.canary
+                if int(canary) < 1:
+                    raise Exception("--canary should be at least 1")
+                if args.wave_growth is not None:
+                    wave_growth, = args.wave_growth
+                    wave_growth = float(wave_growth)
+                else:
+                    wave_growth = ROLLOUT_GROWTH
+                if args.failure_threshold is not None:
+                    failure_threshold, = args.failure_threshold
+                    failure_threshold = float(failure_threshold)
+                else:
+                    failure_threshold = ROLLOUT_FAILURE_THRESHOLD
+                waves = rollout_waves(interleave_targets(targets), int(canary), wave_growth)
+            else:
+                waves = [targets]
+
+            # Run pipelines in bounded pool, results are printed as JSON lines as soon as pipelines finish
+            results = []
+            rollout_aborted = False
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+                for wave_number, wave in enumerate(waves, start=1):
+
+                    # Targets of waves after aborted one are skipped
+                    if rollout_aborted:
+                        for client, salt_project, asset, cmd in wave:
+                            result = {"client": client, "project": salt_project, "target": asset, "pipeline_url": "", "pipeline_status": "skipped", "error": "rollout aborted", "duration": None}
+                            print(json.dumps(result, sort_keys=True))
+                            results.append(result)
+                        continue
+
+                    wave_results = []
+                    futures = [executor.submit(pipeline_salt_cmd, *target) for target in wave]
+                    for future in concurrent.futures.as_completed(futures):
+                        result = future.result()
+                        print(json.dumps(result, sort_keys=True))
+                        sys.stdout.flush()
+                        wave_results.append(result)
+                    results.extend(wave_results)
+
+                    # Abort rollout if too many pipelines of wave failed
+                    if args.canary is not None:
+                        wave_failed = len([result for result in wave_results if result["pipeline_status"] != "success"])
+                        if wave_failed*100 > failure_threshold*len(wave_results):
+                            rollout_aborted = True
+                        print(json.dumps({"wave": {"number": wave_number, "of": len(waves), "total": len(wave_results), "failed": wave_failed, "aborted": rollout_aborted}}, sort_keys=True))
+                        sys.stdout.flush()
+
+            # Exit with error if some pipelines failed
+            failed = print_pipeline_summary(results)
+            if failed > 0:
+                raise Exception("{failed} of {total} pipelines did not succeed".format(failed=failed, total=len(results)))
 
     # Reroute catched exception to log
     except Exception as e:
         logger.exception(e)
+        log_tariff_cache_stats(logger)
         logger.info("Finished {LOGO} with errors".format(LOGO=LOGO))
         sys.exit(1)
 
+    log_tariff_cache_stats(logger)
     logger.info("Finished {LOGO}".format(LOGO=LOGO))
@@ -11,11 +11,34 @@ from collections import OrderedDict
 import json
 import argparse
 import glob
+import fnmatch
+import re
+import bisect
+import concurrent.futures
+import functools
+import subprocess
+import threading
+import collections
+import hashlib
+import pickle
+import stat
+import tempfile
+import timeit
+import uuid
 from datetime import datetime
 from datetime import time
+from datetime import timedelta
+from time import sleep
 from mergedeep import merge
+import gitlab
 #import pdb
 
+# Use libyaml C loader if PyYAML is built with it, it is several times faster than pure Python SafeLoader
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 # Custom Exceptions
 class DictError(Exception):
     pass
@@ -44,16 +67,80 @@ def load_json(f, l):
                 raise LoadError("Reading JSON from file '{0}' failed".format(f))
     return json_dict
 
+# Parse YAML data, whole file data is passed at once to avoid loader reading stream in small chunks
+def parse_yaml(yaml_data, loader=None):
+    return yaml.load(yaml_data, Loader=loader if loader is not None else YamlLoader)
+
 # Load YAML
 def load_yaml(f, l):
     l.info("Loading YAML from file {0}".format(f))
     try:
-        with open(f, 'r') as yaml_file:
-            yaml_dict = yaml.load(yaml_file, Loader=yaml.SafeLoader)
+        with open(f, 'rb') as yaml_file:
+            yaml_dict = parse_yaml(yaml_file.read())
     except:
         raise LoadError("Reading YAML from file '{0}' failed".format(f))
     return yaml_dict
 
+# Benchmark YAML file parsing with pure Python and C loaders, returns best seconds per parse for each, None if C loader is not available
+def benchmark_yaml_file(f, repeat):
+    with open(f, 'rb') as yaml_file:
+        yaml_data = yaml_file.read()
+    results = []
+    for loader in [yaml.SafeLoader, getattr(yaml, "CSafeLoader", None)]:
+        if loader is None:
+            results.append(None)
+            continue
+        best = None
+        for i in range(repeat):
+            started = timeit.default_timer()
+            parse_yaml(yaml_data, loader)
+            elapsed = timeit.default_timer() - started
+            if best is None or elapsed < best:
+                best = elapsed
+        results.append(best)
+    return results
+
+# Process wide tariff cache, each tariff file is parsed once and the same dict is returned to every caller
+# Tariff dicts are shared, so callers must copy them before adding or changing keys
+TARIFF_CACHE = {}
+TARIFF_CACHE_STATS = {"hits": 0, "misses": 0}
+TARIFF_CACHE_MTIMES = {}
+
+# Load tariff YAML via tariff cache
+def load_tariff_yaml(WORK_DIR, TARIFFS_SUBDIR, tariff_file, logger):
+    tariff_path = "{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, tariff_file)
+    if tariff_path in TARIFF_CACHE:
+        TARIFF_CACHE_STATS["hits"] += 1
+        return TARIFF_CACHE[tariff_path]
+    TARIFF_CACHE_STATS["misses"] += 1
+    try:
+        TARIFF_CACHE_MTIMES[tariff_path] = os.stat(tariff_path).st_mtime_ns
+    except OSError:
+        TARIFF_CACHE_MTIMES[tariff_path] = None
+    tariff_dict = load_yaml(tariff_path, logger)
+    TARIFF_CACHE[tariff_path] = tariff_dict
+    return tariff_dict
+
+# Drop changed tariff files from tariff cache, used by long running processes, returns True if some file was dropped
+def refresh_tariff_cache(logger):
+    dropped = False
+    for tariff_path in list(TARIFF_CACHE):
+        try:
+            tariff_mtime_ns = os.stat(tariff_path).st_mtime_ns
+        except OSError:
+            tariff_mtime_ns = None
+        if tariff_mtime_ns != TARIFF_CACHE_MTIMES[tariff_path]:
+            logger.info("Tariff file {0} changed, dropping it from tariff cache".format(tariff_path))
+            del TARIFF_CACHE[tariff_path]
+            # Tariff records are keyed by tariff file relative to tariffs dir, drop them all
+            TARIFF_RECORDS.clear()
+            dropped = True
+    return dropped
+
+# Log tariff cache hits and misses
+def log_tariff_cache_stats(logger):
+    logger.info("Tariff cache stats: {hits} hits, {misses} misses (files parsed)".format(hits=TARIFF_CACHE_STATS["hits"], misses=TARIFF_CACHE_STATS["misses"]))
+
 # Load FILE
 def load_file_string(f, l):
     l.info("Loading string from file {0}".format(f))
@@ -82,34 +169,100 @@ def set_logger(console_level, log_dir, log_file):
     logger.addHandler(console_handler)
     return logger
 
+# Sorted activation index for asset tariffs list, the list is searched top down for the first tariff activated before event date time
+class TariffIndex:
+
+    __slots__ = ("tariffs", "dates", "positions")
+
+    def __init__(self, tariffs):
+        self.tariffs = tariffs
+        entries = sorted((datetime.combine(tariff["activated"], time.min), position) for position, tariff in enumerate(tariffs))
+        self.dates = [entry[0] for entry in entries]
+        # For each activation date keep the topmost list position activated at or before it, so unsorted lists give the same result as top down search
+        self.positions = []
+        top_position = None
+        for entry in entries:
+            if top_position is None or entry[1] < top_position:
+                top_position = entry[1]
+            self.positions.append(top_position)
+
+    # Position of activated tariff in tariffs list for event date time, None if out of available tariffs
+    def position(self, event_date_time):
+        i = bisect.bisect_right(self.dates, event_date_time)
+        if i == 0:
+            return None
+        return self.positions[i-1]
+
+    # Activated tariff for event date time or None
+    def activated(self, event_date_time):
+        position = self.position(event_date_time)
+        if position is None:
+            return None
+        return self.tariffs[position]
+
+    # Tariff next to activated in tariffs list (older one) for event date time or None
+    def older(self, event_date_time):
+        position = self.position(event_date_time)
+        if position is None or position+1 >= len(self.tariffs):
+            return None
+        return self.tariffs[position+1]
+
+    # Activated tariffs for many event date times in one call
+    def activated_bulk(self, event_date_times):
+        return [self.activated(event_date_time) for event_date_time in event_date_times]
+
+# Asset tariffs list which keeps its own activation index, so index lives and dies with the loaded client
+class TariffList(list):
+
+    __slots__ = ("activation_index",)
+
+    def __init__(self, tariffs):
+        super().__init__(tariffs)
+        self.activation_index = None
+
+# Get or build tariff index for asset tariffs list, plain lists (not loaded via load_client_yaml) get one off index
+def get_tariff_index(tariffs):
+    if not isinstance(tariffs, TariffList):
+        return TariffIndex(tariffs)
+    tariff_index = tariffs.activation_index
+    if tariff_index is None or len(tariff_index.dates) != len(tariffs):
+        tariff_index = TariffIndex(tariffs)
+        tariffs.activation_index = tariff_index
+    return tariff_index
+
+# Build tariff indexes for all client assets once on client load
+def index_client_tariffs(client_dict, logger):
+    # Broken assets or tariffs will raise later on asset list or activated tariff search, exactly where they did before
+    try:
+        for asset in client_asset_dicts(client_dict):
+            if "tariffs" in asset:
+                if not isinstance(asset["tariffs"], TariffList):
+                    asset["tariffs"] = TariffList(asset["tariffs"])
+                get_tariff_index(asset["tariffs"])
+    except (KeyError, TypeError, AttributeError) as e:
+        logger.warning("Cannot build tariff indexes for client {0}: {1}".format(client_dict.get("name"), e))
+
 # Helps to find tariff in tariffs list which is activated for event date
 def activated_tariff(tariffs, event_date_time, logger):
-    event_tariff = None
-    for tariff in tariffs:
-        tariff_date_time = datetime.combine(tariff["activated"], time.min)
-        # Event datetime must be later than tariff datetime
-        if event_date_time >= tariff_date_time:
-            event_tariff = tariff
-            break
+    event_tariff = get_tariff_index(tariffs).activated(event_date_time)
     if event_tariff is not None:
         logger.info("Found activated tariff {0} for event date time {1}".format(event_tariff, event_date_time))
         return event_tariff
     else:
         raise Exception("Event date time {0} out of available tariffs date time".format(event_date_time))
 
+# The same as activated_tariff but for many event date times of one asset
+def activated_tariff_bulk(tariffs, event_date_times, logger):
+    event_tariffs = get_tariff_index(tariffs).activated_bulk(event_date_times)
+    for event_date_time, event_tariff in zip(event_date_times, event_tariffs):
+        if event_tariff is None:
+            raise Exception("Event date time {0} out of available tariffs date time".format(event_date_time))
+    logger.info("Found activated tariffs for {0} event date times".format(len(event_tariffs)))
+    return event_tariffs
+
 # Helps to find tariff older than activated tariff, needed for month portion logic
 def tariff_older_than_activated_tariff(tariffs, event_date_time, logger):
-    older_tariff = None
-    i = 0
-    for tariff in tariffs:
-        tariff_date_time = datetime.combine(tariff["activated"], time.min)
-        # Event datetime must be later than tariff datetime
-        if event_date_time >= tariff_date_time:
-            # If we found tariff which is activated for event date - search if next item in list exists - it will be the older tariff
-            if i+1 < len(tariffs):
-                older_tariff = tariffs[i+1]
-            break
-        i += 1
+    older_tariff = get_tariff_index(tariffs).older(event_date_time)
     if older_tariff is not None:
         logger.info("Found tariff older than activated tariff {0} for event date time {1}".format(older_tariff, event_date_time))
     else:
@@ -139,7 +292,7 @@ def get_active_assets(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime
                 # If tariff has file key - load it
                 if "file" in asset_tariff:
 
-                    tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
+                    tariff_dict = load_tariff_yaml(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"], logger)
                     if tariff_dict is None:
                         raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
 
@@ -162,8 +315,8 @@ def get_active_assets(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime
 
     return assets, tariffs, licenses
 
-# Get asset list
-def get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, only_active=True):
+# Raw asset dicts of client from servers (deprecated), assets and salt masters
+def client_asset_dicts(client_dict):
 
     # Prepare asset list from servers (deprecated) and assets
     asset_list_to_process = []
@@ -176,6 +329,13 @@ def get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, o
     if "configuration_management" in client_dict and client_dict["configuration_management"]["type"] == "salt":
         asset_list_to_process.extend(client_dict["configuration_management"]["salt"]["masters"])
 
+    return asset_list_to_process
+
+# Get asset list
+def get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, only_active=True):
+
+    asset_list_to_process = client_asset_dicts(client_dict)
+
     asset_list = []
     # Set additional or default fields in assets
 
@@ -186,6 +346,9 @@ def get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, o
             if not asset["active"]:
                 continue
 
+        # Asset dicts are shared by registry, set fields on a shallow copy
+        asset = dict(asset)
+
         # Default kind: server
         if "kind" not in asset:
             asset["kind"] = "server"
@@ -199,7 +362,7 @@ def get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, o
             # If tariff has file key - load it
             if "file" in asset_tariff:
 
-                tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
+                tariff_dict = load_tariff_yaml(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"], logger)
                 if tariff_dict is None:
 
                     raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
@@ -215,74 +378,579 @@ def get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, o
 
     return asset_list
 
-# Load asset YAML
-def load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger):
+# Compact tariff record made from tariff file or inline tariff
+class Tariff:
+
+    __slots__ = ("file", "service", "plan", "revision", "licenses", "hourly")
+
+    def __init__(self, tariff_dict, tariff_file=None):
+        self.file = tariff_file
+        self.service = tariff_dict.get("service")
+        self.plan = tariff_dict.get("plan")
+        self.revision = tariff_dict.get("revision")
+        self.licenses = tuple(tariff_dict["licenses"]) if "licenses" in tariff_dict else ()
+        self.hourly = tariff_dict.get("hourly")
+
+# Tariff records are shared the same way as tariff dicts in tariff cache
+TARIFF_RECORDS = {}
+
+# Get tariff record for asset tariff, tariff file is loaded via tariff cache
+def get_tariff_record(WORK_DIR, TARIFFS_SUBDIR, asset_tariff, logger):
+
+    # Inline plan and service
+    if "file" not in asset_tariff:
+        return Tariff(asset_tariff)
+
+    if asset_tariff["file"] not in TARIFF_RECORDS:
+        tariff_dict = load_tariff_yaml(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"], logger)
+        if tariff_dict is None:
+            raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
+        TARIFF_RECORDS[asset_tariff["file"]] = Tariff(tariff_dict, asset_tariff["file"])
+
+    return TARIFF_RECORDS[asset_tariff["file"]]
+
+# Compact asset record with defaults applied once, asset YAML dict is not modified
+class Asset:
+
+    __slots__ = ("fqdn", "kind", "active", "os", "jobs", "jobs_disabled", "ssh_host", "ssh_port", "ssh_jump", "tariffs", "activated_tariff", "licenses")
+
+    def __init__(self, asset_dict, activated_tariff):
+        self.fqdn = asset_dict["fqdn"]
+        self.kind = asset_dict.get("kind", "server")
+        self.active = asset_dict.get("active", True)
+        self.os = asset_dict.get("os")
+        self.jobs = asset_dict.get("jobs", {})
+        self.jobs_disabled = bool(asset_dict.get("jobs_disabled", False))
+        self.tariffs = asset_dict["tariffs"]
+        self.activated_tariff = activated_tariff
+
+        # Joined licenses of all activated tariffs
+        self.licenses = frozenset(lic for tariff in activated_tariff for lic in tariff.licenses)
+
+        # Connect host:port and jump
+        ssh = asset_dict.get("ssh", {})
+        self.ssh_host = ssh.get("host", self.fqdn)
+        self.ssh_port = ssh.get("port", "22")
+        if "jump" in ssh:
+            self.ssh_jump = "{host}:{port}".format(host=ssh["jump"]["host"], port=ssh["jump"].get("port", "22"))
+        else:
+            self.ssh_jump = None
+
+# Get asset records, the same as get_asset_list but with Asset and Tariff records
+def get_asset_records(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, only_active=True):
+
+    asset_records = []
+
+    for asset in client_asset_dicts(client_dict):
+
+        # Skip not active assets if only_active
+        if only_active:
+            if not asset["active"]:
+                continue
+
+        logger.info("Checking activated tariff for asset {0}".format(asset["fqdn"]))
+
+        # Set activated tariff
+        asset_activated_tariff = tuple(get_tariff_record(WORK_DIR, TARIFFS_SUBDIR, asset_tariff, logger) for asset_tariff in activated_tariff(asset["tariffs"], at_datetime, logger)["tariffs"])
+
+        asset_records.append(Asset(asset, asset_activated_tariff))
+
+    return asset_records
+
+# Compact job record, job params dict from accounting or client YAML is not modified
+# Records are shared by all assets of client via job table, so they are frozen after init
+class Job:
+
+    __slots__ = ("id", "level", "type", "cmd", "timeout", "tz", "os_include", "os_exclude", "disabled", "licenses", "salt_ssh", "severity_override", "params")
+
+    def __init__(self, job_id, level, job_params):
+        self.id = job_id
+        self.level = level
+        self.type = job_params.get("type")
+        self.cmd = job_params.get("cmd")
+        self.timeout = job_params.get("timeout")
+        self.tz = job_params.get("tz")
+        job_os = job_params.get("os", {})
+        self.os_include = job_os.get("include")
+        self.os_exclude = job_os.get("exclude")
+        self.disabled = bool(job_params.get("disabled", False))
+        self.licenses = frozenset(job_params["licenses"]) if job_params.get("licenses") is not None else None
+        self.salt_ssh = bool(job_params.get("salt-ssh", False))
+        self.severity_override = job_params.get("severity_override")
+        self.params = job_params
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise Exception("Job {0} record is frozen, cannot set {1}".format(self.id, name))
+        object.__setattr__(self, name, value)
+
+    # Job as dict for logs
+    def as_dict(self):
+        job_dict = dict(self.params)
+        job_dict["id"] = self.id
+        job_dict["level"] = self.level
+        return job_dict
+
+# Job table of client, global and client jobs are merged once, assets only add their overrides
+class JobTable:
+
+    __slots__ = ("jobs",)
+
+    def __init__(self, global_jobs, client_jobs):
+        jobs = OrderedDict()
+        if global_jobs is not None:
+            for job_id, job_params in global_jobs.items():
+                jobs[job_id] = Job(job_id, "GLOBAL", job_params)
+        # Client job replaces global job with the same id and goes after global jobs
+        if client_jobs is not None:
+            for job_id, job_params in client_jobs.items():
+                jobs.pop(job_id, None)
+                jobs[job_id] = Job(job_id, "CLIENT", job_params)
+        self.jobs = tuple(jobs.values())
+
+    # Job list for asset, asset jobs replace table jobs with the same id and go last
+    def for_asset(self, asset_jobs):
+        if len(asset_jobs) == 0:
+            return self.jobs
+        return tuple(job for job in self.jobs if job.id not in asset_jobs) + tuple(Job(job_id, "ASSET", job_params) for job_id, job_params in asset_jobs.items())
+
+    # Job table as list of dicts for logs
+    def as_list(self):
+        return [job.as_dict() for job in self.jobs]
+
+# Job tables by ids of global and client jobs dicts
+JOB_TABLES = {}
+
+# Get job table for global and client jobs dicts, built once per pair of dicts, returns (table, True if just built)
+def get_job_table(global_jobs, client_jobs):
+    key = (id(global_jobs), id(client_jobs))
+    job_table = JOB_TABLES.get(key)
+    if job_table is not None and job_table[0] is global_jobs and job_table[1] is client_jobs:
+        return job_table[2], False
+    job_table = (global_jobs, client_jobs, JobTable(global_jobs, client_jobs))
+    JOB_TABLES[key] = job_table
+    return job_table[2], True
+
+# Weekday names as in job weekdays, index is datetime.weekday()
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+# Expand job schedule list like [1, "3-5"] to values, ranges are inclusive, single values are expanded to jitter values from them
+def expand_schedule_values(schedule_list, jitter=1):
+    values = []
+    for item in schedule_list:
+        if len(str(item).split("-")) > 1:
+            values.extend(range(int(str(item).split("-")[0]), int(str(item).split("-")[1])+1))
+        else:
+            values.extend(range(int(item), int(item) + jitter))
+    return values
+
+# Make bitset of values, values out of 0..size-1 never match and are dropped
+def schedule_bitset(values, size):
+    bitset = 0
+    for value in values:
+        if 0 <= value < size:
+            bitset |= 1 << value
+    return bitset
+
+# Max wall clock shift on DST change in any timezone
+DST_MAX_SHIFT = timedelta(hours=2)
+
+# Datetime in timezone with wall clock of its offset, pytz aware arithmetic and astimezone to the same tzinfo keep old offset
+def normalize_timezone(dt, tz):
+    if hasattr(tz, "normalize"):
+        return tz.normalize(dt.astimezone(tz))
+    return dt.astimezone(tz)
+
+# Times of wall clock time in timezone in order, two on DST end and none in gap on DST start
+def localize_wall_time(tz, wall_time):
+    if not hasattr(tz, "localize"):
+        return [wall_time.replace(tzinfo=tz)]
+    # The same time with and without DST is the only one, otherwise wall clock is repeated or skipped
+    localized = [tz.localize(wall_time, is_dst=True), tz.localize(wall_time, is_dst=False)]
+    if localized[0] == localized[1]:
+        return localized[:1]
+    return sorted(candidate for candidate in localized if tz.normalize(candidate).replace(tzinfo=None) == wall_time)
+
+# Job schedule compiled once from job each/minutes/hours/days/months/years/weekdays keys
+# Keys not set in job are None and match any time, minutes are expanded with jitter like single minutes in job
+class JobSchedule:
+
+    __slots__ = ("interval", "minutes", "hours", "days", "months", "years", "weekdays", "fingerprint")
+
+    def __init__(self, job_params, minutes_jitter):
+
+        # Interval between runs from each key, jitter is subtracted twice to not miss run window
+        if "each" in job_params:
+            each = job_params["each"]
+            self.interval = 0-2*minutes_jitter*60
+            self.interval += 60*60*24*365*each.get("years", 0)
+            self.interval += 60*60*24*31*each.get("months", 0)
+            self.interval += 60*60*24*7*each.get("weeks", 0)
+            self.interval += 60*60*24*each.get("days", 0)
+            self.interval += 60*60*each.get("hours", 0)
+            self.interval += 60*each.get("minutes", 0)
+        else:
+            self.interval = None
+
+        self.minutes = schedule_bitset(expand_schedule_values(job_params["minutes"], minutes_jitter), 60) if "minutes" in job_params else None
+        self.hours = schedule_bitset(expand_schedule_values(job_params["hours"]), 24) if "hours" in job_params else None
+        self.days = schedule_bitset(expand_schedule_values(job_params["days"]), 32) if "days" in job_params else None
+        self.months = schedule_bitset(expand_schedule_values(job_params["months"]), 13) if "months" in job_params else None
+        self.years = frozenset(expand_schedule_values(job_params["years"])) if "years" in job_params else None
+        self.weekdays = schedule_bitset([WEEKDAYS.index(weekday) for weekday in job_params["weekdays"] if weekday in WEEKDAYS], 7) if "weekdays" in job_params else None
+
+        # Compiled schedule with job timezone as short string, saved next runs are valid only for the same fingerprint
+        self.fingerprint = hashlib.md5(repr((job_params.get("tz"), self.interval, self.minutes, self.hours, self.days, self.months, sorted(self.years) if self.years is not None else None, self.weekdays)).encode("utf-8")).hexdigest()
+
+    # Reason why time does not match schedule, None if it matches
+    def time_skip_reason(self, at):
+        if self.minutes is not None and not self.minutes >> at.minute & 1:
+            return "now minute {0} is not in run minutes".format(at.minute)
+        if self.hours is not None and not self.hours >> at.hour & 1:
+            return "now hour {0} is not in run hours".format(at.hour)
+        if self.days is not None and not self.days >> at.day & 1:
+            return "now day {0} is not in run days".format(at.day)
+        if self.months is not None and not self.months >> at.month & 1:
+            return "now month {0} is not in run months".format(at.month)
+        if self.years is not None and at.year not in self.years:
+            return "now year {0} is not in run years".format(at.year)
+        if self.weekdays is not None and not self.weekdays >> at.weekday() & 1:
+            return "now weekday {0} is not in run weekdays".format(WEEKDAYS[at.weekday()])
+        return None
+
+    # Reason why job is not due now after last run, None if it is due
+    def skip_reason(self, now, last_run):
+        if self.interval is not None:
+            seconds_since_last_run = (now - last_run).total_seconds()
+            if seconds_since_last_run < self.interval:
+                return "seconds since last run {0} < {1} seconds needed to wait from each key".format(seconds_since_last_run, self.interval)
+        return self.time_skip_reason(now)
+
+    def is_due(self, now, last_run):
+        return self.skip_reason(now, last_run) is None
+
+    # Check day matches days, months, years and weekdays
+    def day_matches(self, day):
+        return (
+            (self.days is None or self.days >> day.day & 1)
+            and (self.months is None or self.months >> day.month & 1)
+            and (self.years is None or day.year in self.years)
+            and (self.weekdays is None or self.weekdays >> day.weekday() & 1)
+        )
+
+    # Wall clock minutes matching schedule from start on in order, within max_days
+    def wall_times(self, start, max_days):
+        day = datetime.combine(start.date(), time.min)
+        for day_number in range(max_days):
+            if self.day_matches(day):
+                for hour in range(start.hour if day_number == 0 else 0, 24):
+                    if self.hours is not None and not self.hours >> hour & 1:
+                        continue
+                    for minute in range(start.minute if day_number == 0 and hour == start.hour else 0, 60):
+                        if self.minutes is not None and not self.minutes >> minute & 1:
+                            continue
+                        yield day.replace(hour=hour, minute=minute)
+            day += timedelta(days=1)
+
+    # First minute after datetime when job is due by wall clock in timezone of after, None if not found within max_days
+    # Schedule is shifted by offset minutes of wall clock as in skip_reason(now - offset), so returned time is not shifted
+    # With last_run given interval from each key is respected as well, job may become due within that minute
+    def next_run(self, after, last_run=None, offset=0, max_days=366*4):
+        earliest = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        if self.interval is not None and last_run is not None:
+            not_before = last_run + timedelta(seconds=self.interval, minutes=offset)
+            if after.tzinfo is not None:
+                not_before = normalize_timezone(not_before, after.tzinfo)
+            # Minute when interval passes is taken, so next run is never later than real one
+            not_before = not_before.replace(second=0, microsecond=0)
+            if not_before > earliest:
+                earliest = not_before
+        if after.tzinfo is None:
+            for wall_time in self.wall_times(earliest - timedelta(minutes=offset), max_days):
+                return wall_time + timedelta(minutes=offset)
+            return None
+        # Wall clock goes back on DST end and times of repeated wall clock are not in order
+        # If earliest is in repeated wall clock, earlier wall times can still be after it, so walk starts DST_MAX_SHIFT before
+        # If found time is in repeated wall clock, later wall times can be before it, so walk goes on for DST_MAX_SHIFT after
+        earliest = normalize_timezone(earliest, after.tzinfo)
+        start = earliest.replace(tzinfo=None) - timedelta(minutes=offset)
+        if len(localize_wall_time(after.tzinfo, earliest.replace(tzinfo=None))) > 1:
+            start -= DST_MAX_SHIFT
+        found = None
+        found_repeated = False
+        for wall_time in self.wall_times(start, max_days):
+            wall_time += timedelta(minutes=offset)
+            if found is not None and (not found_repeated or wall_time > found.replace(tzinfo=None) + DST_MAX_SHIFT):
+                break
+            candidates = localize_wall_time(after.tzinfo, wall_time)
+            for candidate in candidates:
+                if candidate >= earliest and (found is None or candidate < found):
+                    found = candidate
+                    found_repeated = len(candidates) > 1
+        return found
+
+# Compiled schedules by id of job params dict
+JOB_SCHEDULES = {}
+
+# Get compiled schedule for job params, compiled once per job params dict
+def get_job_schedule(job_params, minutes_jitter):
+    job_schedule = JOB_SCHEDULES.get(id(job_params))
+    if job_schedule is None or job_schedule[0] is not job_params:
+        job_schedule = (job_params, JobSchedule(job_params, minutes_jitter))
+        JOB_SCHEDULES[id(job_params)] = job_schedule
+    return job_schedule[1]
+
+# Drop compiled schedules of jobs dict, so reloaded YAML does not keep old dicts alive
+def prune_job_schedules(jobs):
+    if not isinstance(jobs, dict):
+        return
+    for job_params in jobs.values():
+        job_schedule = JOB_SCHEDULES.get(id(job_params))
+        if job_schedule is not None and job_schedule[0] is job_params:
+            del JOB_SCHEDULES[id(job_params)]
+
+# Drop job tables and compiled schedules built from global jobs dict, used when accounting yaml is reloaded
+def prune_global_job_caches(global_jobs):
+    if global_jobs is None:
+        return
+    for key, job_table in list(JOB_TABLES.items()):
+        if job_table[0] is global_jobs:
+            del JOB_TABLES[key]
+    prune_job_schedules(global_jobs)
+
+# Drop job tables and compiled schedules built from client dict, used when client is reloaded
+def prune_client_caches(client_dict):
+    # Broken assets were not indexed, nothing to drop for them
+    try:
+        client_assets = client_asset_dicts(client_dict)
+    except (KeyError, TypeError, AttributeError):
+        client_assets = []
+    for asset in client_assets:
+        if not isinstance(asset, dict):
+            continue
+        prune_job_schedules(asset.get("jobs"))
+    client_jobs = client_dict.get("jobs")
+    if client_jobs is not None:
+        for key, job_table in list(JOB_TABLES.items()):
+            if job_table[1] is client_jobs:
+                del JOB_TABLES[key]
+    prune_job_schedules(client_jobs)
+
+# Client cache format, increase on every change of client YAML merge logic to drop old snapshots
+CLIENT_CACHE_FORMAT = 2
+
+# Read YAML file and register it as client cache dependency
+def read_client_yaml_file(path, deps):
+    with open(path, 'rb') as yaml_file:
+        file_stat = os.fstat(yaml_file.fileno())
+        file_data = yaml_file.read()
+    deps.append(("file", os.path.abspath(path), file_stat.st_mtime_ns, file_stat.st_size, hashlib.sha1(file_data).hexdigest()))
+    return parse_yaml(file_data)
+
+# Make client cache dependency for dir, listing digest catches added or removed include files
+def client_cache_dir_dep(path):
+    try:
+        dir_stat = os.stat(path)
+        dir_names = sorted(os.listdir(path))
+    except OSError:
+        return ("dir", os.path.abspath(path), None, None, None)
+    return ("dir", os.path.abspath(path), dir_stat.st_mtime_ns, 0, hashlib.sha1("\n".join(dir_names).encode("utf-8")).hexdigest())
+
+# Check client cache dependency, returns (valid, stat changed)
+def client_cache_dep_valid(dep):
+    kind, path, mtime_ns, size, digest = dep
+    try:
+        dep_stat = os.stat(path)
+    except OSError:
+        return (mtime_ns is None, False)
+    if mtime_ns is None:
+        return (False, False)
+    if kind == "dir":
+        if dep_stat.st_mtime_ns == mtime_ns:
+            return (True, False)
+        return (client_cache_dir_dep(path)[4] == digest, True)
+    if dep_stat.st_mtime_ns == mtime_ns and dep_stat.st_size == size:
+        return (True, False)
+    # Same size but new mtime (e.g. fresh git checkout) - compare content digest, it is still much cheaper than YAML parsing
+    if dep_stat.st_size != size:
+        return (False, False)
+    try:
+        with open(path, 'rb') as dep_file:
+            return (hashlib.sha1(dep_file.read()).hexdigest() == digest, True)
+    except OSError:
+        return (False, False)
+
+# Restat client cache dependency which content is known to be the same
+def client_cache_dep_restat(dep):
+    kind, path, mtime_ns, size, digest = dep
+    dep_stat = os.stat(path)
+    return (kind, path, dep_stat.st_mtime_ns, size, digest)
+
+# Client cache file for client YAML file
+def client_cache_file(cache_dir, source):
+    return "{0}/{1}-{2}.pickle".format(cache_dir, os.path.splitext(os.path.basename(source))[0], hashlib.sha1(source.encode("utf-8")).hexdigest()[:16])
+
+# Pickle runs code from the file on load, so cache file and dir should be owned by us and writable by nobody else
+def client_cache_trusted(cache_file, cache):
+    for path_stat in [os.stat(os.path.dirname(cache_file)), os.fstat(cache.fileno())]:
+        if path_stat.st_uid != os.geteuid() or path_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            return False
+    return True
+
+# Load merged client dict from cache, returns (dict, deps, restat) or (None, None, False) if cache is missing or stale
+def load_client_cache(cache_file, source, logger):
+    try:
+        with open(cache_file, 'rb') as cache:
+            if not client_cache_trusted(cache_file, cache):
+                logger.warning("Client cache {0} or its dir is not owned by current user or is writable by group or others, ignoring".format(cache_file))
+                return (None, None, False)
+            header = pickle.load(cache)
+            if header.get("format") != CLIENT_CACHE_FORMAT or header.get("source") != source:
+                logger.info("Client cache {0} format or source mismatch".format(cache_file))
+                return (None, None, False)
+            restat = False
+            for dep in header["deps"]:
+                dep_valid, dep_restat = client_cache_dep_valid(dep)
+                if not dep_valid:
+                    logger.info("Client cache {0} is stale, changed: {1}".format(cache_file, dep[1]))
+                    return (None, None, False)
+                restat = restat or dep_restat
+            yaml_dict = pickle.load(cache)
+    except FileNotFoundError:
+        return (None, None, False)
+    except Exception as e:
+        logger.warning("Reading client cache {0} failed, ignoring: {1}".format(cache_file, e))
+        return (None, None, False)
+    # Content is the same but stats changed, new stats should be saved to skip digests next time
+    if restat:
+        deps = [client_cache_dep_restat(dep) for dep in header["deps"]]
+    else:
+        deps = header["deps"]
+    return (yaml_dict, deps, restat)
+
+# Save merged client dict to cache atomically, cache errors should not stop anything
+def save_client_cache(cache_file, source, deps, yaml_dict, logger):
+    tmp_file = None
+    try:
+        os.makedirs(os.path.dirname(cache_file), 0o700, exist_ok=True)
+        tmp_fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), prefix=".", suffix=".tmp")
+        with os.fdopen(tmp_fd, 'wb') as cache:
+            pickle.dump({"format": CLIENT_CACHE_FORMAT, "source": source, "deps": deps}, cache, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(yaml_dict, cache, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+        logger.info("Saved client cache {0}".format(cache_file))
+    except Exception as e:
+        logger.warning("Saving client cache {0} failed, ignoring: {1}".format(cache_file, e))
+        if tmp_file is not None and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+# Load asset YAML, use cache_dir for merged client snapshots if set
+# Files and dirs the client is made of are added to deps_out if set
+def load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger, cache_dir=None, deps_out=None):
+
+    if cache_dir:
+        source = os.path.abspath("{0}/{1}".format(WORK_DIR, f))
+        cache_file = client_cache_file(cache_dir, source)
+        yaml_dict, deps, restat = load_client_cache(cache_file, source, logger)
+        if yaml_dict is not None:
+            logger.info("Loaded asset YAML from cache {0} for file {1}/{2}".format(cache_file, WORK_DIR, f))
+            if restat:
+                save_client_cache(cache_file, source, deps, yaml_dict, logger)
+            if deps_out is not None:
+                deps_out.extend(deps)
+            index_client_tariffs(yaml_dict, logger)
+            return yaml_dict
+
+    deps = []
+    yaml_dict = parse_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger, deps)
+
+    if cache_dir:
+        save_client_cache(cache_file, source, deps, yaml_dict, logger)
+
+    if deps_out is not None:
+        deps_out.extend(deps)
+
+    index_client_tariffs(yaml_dict, logger)
+
+    return yaml_dict
+
+# Compile substring skip list into one regex, None if there is nothing to skip
+def compile_skip_matcher(skip_list):
+    if len(skip_list) == 0:
+        return None
+    return re.compile("|".join(re.escape(str(skip)) for skip in skip_list))
+
+# Find include files in dir tree in one pass, hidden and skipped dirs are not descended into
+# Files are returned in sorted full path order the same as sorted recursive glob, every dir scanned is added to deps
+def find_include_files(dir_path, name_matcher, skip_matcher, deps):
+    deps.append(client_cache_dir_dep(dir_path))
+    include_files = []
+    dir_paths = [dir_path]
+    while len(dir_paths) > 0:
+        current_path = dir_paths.pop()
+        try:
+            entries = list(os.scandir(current_path))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            entry_path = os.path.join(current_path, entry.name)
+            # Skip strings are matched as substrings of path, so everything under matched dir is skipped as well
+            if skip_matcher is not None and skip_matcher.search(entry_path):
+                continue
+            if entry.is_dir():
+                deps.append(client_cache_dir_dep(entry_path))
+                dir_paths.append(entry_path)
+            elif name_matcher.match(entry.name):
+                include_files.append(entry_path)
+    return sorted(include_files)
+
+# Merge included YAML into client YAML, assets or servers (deprecated) are appended to accumulated lists instead of merging
+def merge_included_yaml(yaml_dict, included_yaml_dict, servers, assets):
+    if included_yaml_dict is not None:
+        if "servers" in included_yaml_dict:
+            servers.extend(included_yaml_dict.pop("servers"))
+        if "assets" in included_yaml_dict:
+            assets.extend(included_yaml_dict.pop("assets"))
+        merge(yaml_dict, included_yaml_dict)
+    yaml_dict["servers"] = servers
+    yaml_dict["assets"] = assets
+
+# Parse asset YAML with includes, every file or dir used is added to deps
+def parse_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger, deps):
     logger.info("Loading asset YAML from file {0}/{1}".format(WORK_DIR, f))
     try:
-        with open("{0}/{1}".format(WORK_DIR, f), 'r') as yaml_file:
-            yaml_dict = yaml.load(yaml_file, Loader=yaml.SafeLoader)
+        yaml_dict = read_client_yaml_file("{0}/{1}".format(WORK_DIR, f), deps)
     except:
         raise LoadError("Reading YAML from file {0}/{1} failed".format(WORK_DIR, f))
     
     # Asset YAMLs have could have includes
     if "include" in yaml_dict:
 
+        # Assets or servers (deprecated) from included files are accumulated in new lists instead of copying on every merge
+        servers = list(yaml_dict["servers"]) if "servers" in yaml_dict else []
+        assets = list(yaml_dict["assets"]) if "assets" in yaml_dict else []
+
         # Include dirs
         if "dirs" in yaml_dict["include"]:
 
+            name_matcher = re.compile(fnmatch.translate(YAML_GLOB))
+            skip_matcher = compile_skip_matcher(yaml_dict["include"].get("skip_files", []) + yaml_dict["include"].get("skip_dirs", []))
+
             for dir_name in yaml_dict["include"]["dirs"]:
 
                 # Include dir_name/*.yaml
-                for include_file in sorted(glob.glob("{0}/{1}/{2}/{3}/{4}".format(WORK_DIR, CLIENTS_SUBDIR, dir_name, "**/", YAML_GLOB), recursive = True)):
+                for include_file in find_include_files("{0}/{1}/{2}".format(WORK_DIR, CLIENTS_SUBDIR, dir_name), name_matcher, skip_matcher, deps):
 
                     logger.info("Found include file: {0}".format(include_file))
 
-                    # Skip skip_files in found dir
-                    should_open = True
-                    if "skip_files" in yaml_dict["include"]:
-                        for skip_file in yaml_dict["include"]["skip_files"]:
-                            if skip_file in include_file:
-                                should_open = False
-                    if "skip_dirs" in yaml_dict["include"]:
-                        for skip_dir in yaml_dict["include"]["skip_dirs"]:
-                            if skip_dir in include_file:
-                                should_open = False
-                    if should_open:
-                        try:
-                            with open(include_file, 'r') as included_yaml_file:
-                                included_yaml_dict = yaml.load(included_yaml_file, Loader=yaml.SafeLoader)
-                        except:
-                            raise LoadError("Reading YAML from file {0} failed".format(include_file))
-                    else:
-                        continue
+                    try:
+                        included_yaml_dict = read_client_yaml_file(include_file, deps)
+                    except:
+                        raise LoadError("Reading YAML from file {0} failed".format(include_file))
 
-                    # Save previous assets or servers (deprecated) list before merging dicts
-                    if "servers" in yaml_dict:
-                        old_servers = yaml_dict["servers"]
-                    else:
-                        old_servers = []
-                    if "assets" in yaml_dict:
-                        old_assets = yaml_dict["assets"]
-                    else:
-                        old_assets = []
-
-                    # Save new assets or servers (deprecated) list before merging dicts
-                    if included_yaml_dict is not None and "servers" in included_yaml_dict:
-                        new_servers = included_yaml_dict["servers"]
-                    else:
-                        new_servers = []
-                    if included_yaml_dict is not None and "assets" in included_yaml_dict:
-                        new_assets = included_yaml_dict["assets"]
-                    else:
-                        new_assets = []
-
-                    # Merge dicts, assets will be replaced by included from file
-                    if included_yaml_dict is not None:
-                        merge(yaml_dict, included_yaml_dict)
-
-                    # Set assets or servers from old and new
-                    yaml_dict["servers"] = old_servers + new_servers
-                    yaml_dict["assets"] = old_assets + new_assets
+                    merge_included_yaml(yaml_dict, included_yaml_dict, servers, assets)
 
         # Include files, data in files supersedes data in dirs
         if "files" in yaml_dict["include"]:
@@ -291,40 +959,401 @@ def load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger):
                 for include_file in yaml_dict["include"]["files"]:
 
                     try:
-                        with open("{0}/{1}".format(CLIENTS_SUBDIR, include_file), 'r') as included_yaml_file:
-                            included_yaml_dict = yaml.load(included_yaml_file, Loader=yaml.SafeLoader)
+                        included_yaml_dict = read_client_yaml_file("{0}/{1}".format(CLIENTS_SUBDIR, include_file), deps)
                     except:
                         raise LoadError("Reading YAML from file {0} failed".format(include_file))
 
-                    # Save previous assets or servers (deprecated) list before merging dicts
-                    if "servers" in yaml_dict:
-                        old_servers = yaml_dict["servers"]
-                    else:
-                        old_servers = []
-                    if "assets" in yaml_dict:
-                        old_assets = yaml_dict["assets"]
-                    else:
-                        old_assets = []
-
-                    # Save new assets or servers (deprecated) list before merging dicts
-                    if included_yaml_dict is not None and "servers" in included_yaml_dict:
-                        new_servers = included_yaml_dict["servers"]
-                    else:
-                        new_servers = []
-                    if included_yaml_dict is not None and "assets" in included_yaml_dict:
-                        new_assets = included_yaml_dict["assets"]
-                    else:
-                        new_assets = []
-
-                    # Merge dicts, assets will be replaced by included from file
-                    if included_yaml_dict is not None:
-                        merge(yaml_dict, included_yaml_dict)
-
-                    # Set assets or servers from old and new
-                    yaml_dict["servers"] = old_servers + new_servers
-                    yaml_dict["assets"] = old_assets + new_assets
+                    merge_included_yaml(yaml_dict, included_yaml_dict, servers, assets)
 
     # Make sure client name is string
     yaml_dict["name"] = str(yaml_dict["name"])
 
     return yaml_dict
+
+# Load client YAML in pool worker process, errors are left for serial load in parent to raise or handle
+# Returns (client_dict, deps) or (None, None)
+def load_client_yaml_worker(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, logger, cache_dir, f):
+    try:
+        deps = []
+        return (load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger, cache_dir, deps), deps)
+    except Exception:
+        return (None, None)
+
+# Process wide client registry, each client file is loaded once and the same dict is shared by all loops
+# Clients are selected for all-clients operations with exclude_clients or include_clients lists, None means the list is not set
+class ClientRegistry:
+
+    def __init__(self, WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, YAML_EXT, logger, cache_dir=None, exclude_clients=None, include_clients=None):
+        self.WORK_DIR = WORK_DIR
+        self.CLIENTS_SUBDIR = CLIENTS_SUBDIR
+        self.YAML_GLOB = YAML_GLOB
+        self.YAML_EXT = YAML_EXT
+        self.logger = logger
+        self.cache_dir = cache_dir
+        self.exclude_clients = exclude_clients
+        self.include_clients = include_clients
+        self.client_files = None
+        self.by_file = {}
+        self.by_name = {}
+        self.deps = {}
+        self.fqdn_index = {}
+        self.fqdn_indexed_clients = set()
+
+    # Sorted client files in clients dir
+    def files(self):
+        if self.client_files is None:
+            self.client_files = sorted(glob.glob("{0}/{1}".format(self.CLIENTS_SUBDIR, self.YAML_GLOB)))
+        return self.client_files
+
+    # Load client file once
+    def load(self, client_file):
+        if client_file not in self.by_file:
+            self.logger.info("Found client file: {0}".format(client_file))
+            deps = []
+            client_dict = load_client_yaml(self.WORK_DIR, client_file, self.CLIENTS_SUBDIR, self.YAML_GLOB, self.logger, self.cache_dir, deps)
+            if client_dict is None:
+                raise Exception("Config file error or missing: {0}/{1}".format(self.WORK_DIR, client_file))
+            self.by_file[client_file] = client_dict
+            self.deps[client_file] = deps
+            self.by_name[client_dict["name"].lower()] = client_dict
+        return self.by_file[client_file]
+
+    # Load all not yet loaded client files in pool of worker processes, results are kept in file order
+    def preload(self, workers):
+        client_files = [client_file for client_file in self.files() if client_file not in self.by_file]
+        if workers < 2 or len(client_files) < 2:
+            return
+        self.logger.info("Loading {0} client files with {1} workers".format(len(client_files), workers))
+        worker = functools.partial(load_client_yaml_worker, self.WORK_DIR, self.CLIENTS_SUBDIR, self.YAML_GLOB, self.logger, self.cache_dir)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for client_file, (client_dict, deps) in zip(client_files, executor.map(worker, client_files)):
+                if client_dict is None:
+                    continue
+                # Tariff indexes are per process, build them here
+                index_client_tariffs(client_dict, self.logger)
+                self.by_file[client_file] = client_dict
+                self.deps[client_file] = deps
+                self.by_name[client_dict["name"].lower()] = client_dict
+
+    # Drop clients which files or include dirs changed, they are loaded again on next use, used by long running processes
+    def refresh(self):
+        self.client_files = None
+        for client_file in list(self.by_file):
+            deps_valid = True
+            deps = []
+            for dep in self.deps[client_file]:
+                dep_valid, dep_restat = client_cache_dep_valid(dep)
+                if not dep_valid:
+                    deps_valid = False
+                    break
+                # Content is the same but stats changed, keep new stats to skip digests next time
+                deps.append(client_cache_dep_restat(dep) if dep_restat else dep)
+            if deps_valid:
+                self.deps[client_file] = deps
+                continue
+            self.logger.info("Client file {0} or its includes changed, reloading".format(client_file))
+            client_dict = self.by_file.pop(client_file)
+            del self.deps[client_file]
+            prune_client_caches(client_dict)
+            if self.by_name.get(client_dict["name"].lower()) is client_dict:
+                del self.by_name[client_dict["name"].lower()]
+            # Client assets could have changed, fqdn index is filled again on next use
+            self.fqdn_index = {}
+            self.fqdn_indexed_clients = set()
+
+    # All clients as (client_file, client_dict) sorted by file, loaded as iterated
+    def items(self):
+        for client_file in self.files():
+            yield (client_file, self.load(client_file))
+
+    # Client by name, client file name is lowercased client name
+    def get(self, name):
+        if name.lower() in self.by_name:
+            return self.by_name[name.lower()]
+        return self.load("{0}/{1}.{2}".format(self.CLIENTS_SUBDIR, name.lower(), self.YAML_EXT))
+
+    # Check client is not excluded or included
+    def selected(self, client_dict):
+        return (
+            (self.exclude_clients is not None and client_dict["name"].lower() not in self.exclude_clients)
+            or
+            (self.include_clients is not None and client_dict["name"].lower() in self.include_clients)
+            or
+            (self.exclude_clients is None and self.include_clients is None)
+        )
+
+    # Find client asset by fqdn, assets are put into fqdn -> {client name: asset} index once per client
+    def asset_by_fqdn(self, client_dict, fqdn):
+        client_name = client_dict["name"].lower()
+        if client_name not in self.fqdn_indexed_clients:
+            for asset in client_asset_dicts(client_dict):
+                # Last asset with the same fqdn wins as in linear scan over asset list
+                self.fqdn_index.setdefault(asset["fqdn"], {})[client_name] = asset
+            self.fqdn_indexed_clients.add(client_name)
+        return self.fqdn_index.get(fqdn, {}).get(client_name)
+
+# Run pipeline scripts in pool of threads, at most key_limit scripts with the same key (salt project) run at once
+# Scripts over the key limit wait in per key queue, so they do not hold pool threads
+class PipelinePool:
+
+    def __init__(self, workers, key_limit):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.key_limit = key_limit
+        self.lock = threading.Lock()
+        self.running = {}
+        self.queued = {}
+
+    # Queue script or callable, returned future gets script exit code
+    def submit(self, key, script):
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.queued.setdefault(key, collections.deque()).append((script, future))
+            self.start_queued(key)
+        return future
+
+    # Start queued scripts of key while under key limit, called with lock held
+    def start_queued(self, key):
+        while self.running.get(key, 0) < self.key_limit and len(self.queued.get(key, [])) > 0:
+            script, future = self.queued[key].popleft()
+            # Executor already shut down, fail the future so nobody waits for it forever
+            try:
+                self.executor.submit(self.run_script, key, script, future)
+            except RuntimeError as e:
+                future.set_exception(e)
+                continue
+            self.running[key] = self.running.get(key, 0) + 1
+
+    # Script is bash script or callable returning exit code
+    def run_script(self, key, script, future):
+        try:
+            if callable(script):
+                future.set_result(script())
+            else:
+                future.set_result(subprocess.run(script, shell=True, universal_newlines=True, executable="/bin/bash").returncode)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                self.running[key] -= 1
+                self.start_queued(key)
+
+    # Wait for all scripts to finish, queued ones included, they are started by finishing running ones
+    def shutdown(self):
+        while True:
+            with self.lock:
+                queued_futures = [future for key_queue in self.queued.values() for script, future in key_queue]
+            if len(queued_futures) == 0:
+                break
+            concurrent.futures.wait(queued_futures)
+        self.executor.shutdown(wait=True)
+
+# GitLab connection made and authenticated on first use, so runs without GitLab work do no API calls
+class LazyGitlab:
+
+    def __init__(self, url, private_token, logger):
+        self.url = url
+        self.private_token = private_token
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.gl = None
+
+    def get(self):
+        with self.lock:
+            if self.gl is None:
+                self.logger.info("Connecting to GitLab {0}".format(self.url))
+                gl = gitlab.Gitlab(self.url, private_token=self.private_token)
+                gl.auth()
+                self.gl = gl
+            return self.gl
+
+# Keys of GitLab project metadata in cache
+GITLAB_PROJECT_CACHE_KEYS = ["id", "path_with_namespace", "ssh_url_to_repo", "default_branch"]
+
+# GitLab project metadata cached in JSON file for ttl seconds, GitLab is asked only for missing or expired projects
+class GitlabProjectCache:
+
+    def __init__(self, cache_file, ttl, lazy_gitlab, logger):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.gitlab = lazy_gitlab
+        self.logger = logger
+        self.projects = {}
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r') as cache:
+                    projects = json.load(cache)
+                if not isinstance(projects, dict):
+                    raise Exception("projects should be dict by project path")
+                self.projects = projects
+            except Exception as e:
+                logger.warning("Reading GitLab project cache {0} failed, ignoring: {1}".format(cache_file, e))
+
+    # Project metadata dict with id, path_with_namespace, ssh_url_to_repo and default_branch
+    def get(self, path):
+        now = datetime.now().timestamp()
+        project = self.projects.get(path)
+        # Hand edited or partly written entries are fetched again
+        if not isinstance(project, dict) or any(key not in project for key in GITLAB_PROJECT_CACHE_KEYS) or now - project.get("fetched_at", 0) > self.ttl:
+            gl_project = self.gitlab.get().projects.get(path)
+            project = {
+                "fetched_at": now,
+                "id": gl_project.id,
+                "path_with_namespace": gl_project.path_with_namespace,
+                "ssh_url_to_repo": gl_project.ssh_url_to_repo,
+                "default_branch": gl_project.default_branch
+            }
+            self.projects[path] = project
+            self.save()
+        return project
+
+    def save(self):
+        tmp_file = None
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), 0o700, exist_ok=True)
+            tmp_fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(self.cache_file), prefix=".", suffix=".tmp")
+            with os.fdopen(tmp_fd, 'w') as cache:
+                json.dump(self.projects, cache, indent=4, sort_keys=True)
+            os.replace(tmp_file, self.cache_file)
+        except Exception as e:
+            self.logger.warning("Saving GitLab project cache {0} failed, ignoring: {1}".format(self.cache_file, e))
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+# Token bucket rate limiter shared by threads, rate tokens per second are added up to burst tokens
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        if rate <= 0 or burst < 1:
+            raise Exception("Rate should be > 0 and burst should be >= 1")
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = timeit.default_timer()
+        self.lock = threading.Lock()
+
+    # Take one token, wait until it is available
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = timeit.default_timer()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+# Pipeline statuses which are not final yet
+PIPELINE_RUNNING_STATUSES = ["created", "waiting_for_resource", "preparing", "pending", "running", "scheduled"]
+
+# Trigger salt project pipelines with GitLab API instead of .gitlab-server-job shell scripts
+# One python-gitlab client of LazyGitlab is used, so all pipelines go via one HTTP session
+# Ref and variable names are taken from gitlab:native_pipelines of accounting yaml, they should match pipeline_salt_cmd.sh of salt projects
+class PipelineTrigger:
+
+    def __init__(self, lazy_gitlab, settings, logger):
+        if settings is None:
+            raise Exception("gitlab:native_pipelines missing in accounting yaml, it is needed for --native-pipelines")
+        self.ref = settings.get("ref", "branch")
+        if self.ref not in ["branch", "tag"]:
+            raise Exception("gitlab:native_pipelines:ref should be branch or tag, got {0}".format(self.ref))
+        try:
+            self.variable_names = {name: settings["variables"][name] for name in ["target", "cmd", "timeout"]}
+        except (KeyError, TypeError) as e:
+            raise Exception("gitlab:native_pipelines:variables should have target, cmd and timeout variable names: {0}".format(e))
+        self.gitlab = lazy_gitlab
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.projects = {}
+
+    # Get salt project once per run
+    def project(self, salt_project):
+        with self.lock:
+            if salt_project not in self.projects:
+                self.projects[salt_project] = self.gitlab.get().projects.get(salt_project)
+            return self.projects[salt_project]
+
+    # Create pipeline for target, returns dict with the same keys as pipeline_salt_cmd.sh json output
+    # With ref branch pipeline is created on default branch, with ref tag on new run_* tag made from default branch
+    # Tag ref is only for projects which CI does not run on tag push, otherwise tag push pipeline without variables runs too
+    # Failed trigger result has pipeline_id None and exception text in error, fallback is True only if nothing was created in GitLab yet
+    def trigger(self, salt_project, target, cmd, timeout, variables=None):
+        try:
+            project = self.project(salt_project)
+        except Exception as e:
+            self.logger.exception(e)
+            return self.failed(salt_project, target, e, True)
+        pipeline_variables = [
+            {"key": self.variable_names["target"], "value": target},
+            {"key": self.variable_names["cmd"], "value": cmd},
+            {"key": self.variable_names["timeout"], "value": str(timeout)}
+        ]
+        if variables is not None:
+            for key, value in variables.items():
+                pipeline_variables.append({"key": key, "value": str(value)})
+        if self.ref == "tag":
+            pipeline_ref = "run_{date}_{uid}".format(date=datetime.now().strftime("%Y%m%d%H%M%S"), uid=uuid.uuid4().hex[:8])
+        else:
+            pipeline_ref = project.default_branch
+        try:
+            if self.ref == "tag":
+                project.tags.create({"tag_name": pipeline_ref, "ref": project.default_branch})
+            pipeline = project.pipelines.create({"ref": pipeline_ref, "variables": pipeline_variables})
+        except Exception as e:
+            self.logger.exception(e)
+            # Tag could be created even if request failed or timed out, do not leave it without pipeline
+            if self.ref == "tag":
+                try:
+                    project.tags.delete(pipeline_ref)
+                    self.logger.info("Tag {tag} of failed pipeline deleted in {project}".format(tag=pipeline_ref, project=salt_project))
+                except Exception as delete_e:
+                    self.logger.warning("Cannot delete tag {tag} of failed pipeline in {project}: {error}".format(tag=pipeline_ref, project=salt_project, error=delete_e))
+            return self.failed(salt_project, target, e, False)
+        self.logger.info("Pipeline {id} created for {project} {target} on {ref}: {url}".format(id=pipeline.id, project=salt_project, target=target, ref=pipeline_ref, url=pipeline.web_url))
+        return {
+            "project": salt_project,
+            "target": target,
+            "pipeline_id": pipeline.id,
+            "pipeline_url": pipeline.web_url,
+            "pipeline_status": pipeline.status,
+            "error": "",
+            "fallback": False
+        }
+
+    # Result of failed trigger
+    def failed(self, salt_project, target, e, fallback):
+        return {
+            "project": salt_project,
+            "target": target,
+            "pipeline_id": None,
+            "pipeline_url": "",
+            "pipeline_status": "",
+            "error": str(e),
+            "fallback": fallback
+        }
+
+    # Trigger pipelines for list of (target, cmd, timeout, variables), results are in the same order
+    # GitLab API has no bulk pipeline create, so pipelines are created one by one over the same session, callers run it in their pools for concurrency
+    # Caller can fall back to shell script only for results with fallback True, otherwise pipeline could run twice
+    def trigger_batch(self, salt_project, triggers):
+        return [self.trigger(salt_project, target, cmd, timeout, variables) for target, cmd, timeout, variables in triggers]
+
+    # Poll pipelines of results until they finish or timeout in seconds passes, results are updated in place
+    def wait(self, results, timeout, poll_interval=10):
+        waited = 0
+        while True:
+            running = [result for result in results if result["pipeline_id"] is not None and result["pipeline_status"] in PIPELINE_RUNNING_STATUSES]
+            for result in running:
+                try:
+                    result["pipeline_status"] = self.project(result["project"]).pipelines.get(result["pipeline_id"]).status
+                except Exception as e:
+                    self.logger.exception(e)
+                    result["error"] = str(e)
+            running = [result for result in running if result["pipeline_status"] in PIPELINE_RUNNING_STATUSES]
+            if len(running) == 0 or waited >= timeout:
+                for result in running:
+                    result["error"] = "Pipeline did not finish in {timeout} seconds".format(timeout=timeout)
+                return results
+            sleep(poll_interval)
+            waited += poll_interval